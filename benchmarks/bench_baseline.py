@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the baseline correction methods of hefind with the scipy white top hat
+(the tophat method) for speed and output on synthetic spectra.
+
+Usage::
+
+    python benchmarks/bench_baseline.py [NB_SPECTRA]
+
+"""
+
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import hefind
+
+
+def synthetic_fluxes(nb_spectra, nb_pts=4600, seed=0):
+    """Return a 2-D array of smoothed synthetic spectra with absorption
+    lines."""
+    rng = numpy.random.RandomState(seed)
+    wavs = 10**(3.58 + 1e-4 * numpy.arange(nb_pts))
+    fluxes = (100 * (wavs / 5000.)**-2 +
+              rng.normal(0, 1.5, (nb_spectra, nb_pts)))
+    for line in hefind.HELIUM_LINES:
+        fluxes -= 25 * numpy.exp(-0.5 * ((wavs - line) / 6.)**2)
+    return numpy.array([hefind.smooth_spectrum(row) for row in fluxes])
+
+
+def main(nb_spectra=20):
+    fluxes = synthetic_fluxes(nb_spectra)
+    reference = None
+    print('{:<12} {:>12} {:>14}'.format('method', 'ms/spectrum',
+                                        'max |diff|'))
+    for method in ['tophat', 'fast-tophat', 'poly', 'als']:
+        start = time.time()
+        corrected = numpy.array([hefind.baseline(row, method=method)
+                                 for row in fluxes])
+        elapsed = (time.time() - start) / nb_spectra
+        if reference is None:
+            reference = corrected
+        print('{:<12} {:>12.3f} {:>14.3g}'.format(
+            method, 1e3 * elapsed, numpy.abs(corrected - reference).max()))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure the time taken to import hefind with ``python -X importtime`` and
+check it against a budget. Plotting and scipy must not be imported when
+screening spectra, so importing them also counts as a failure.
+
+Usage::
+
+    python benchmarks/bench_import.py [--budget MS] [--repeat N]
+
+The exit status is 1 if the import is over budget or imports a forbidden
+module.
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+FORBIDDEN = ['matplotlib', 'scipy']
+
+
+def import_times(module):
+    """Import module in a fresh interpreter and return a dict mapping each
+    module imported to its cumulative import time in microseconds."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [path for path in [env.get('PYTHONPATH')] if path])
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        env=env, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode:
+        raise RuntimeError('could not import {}:\n{}'.format(
+            module, process.stderr))
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main(argv=sys.argv[1:]):
+    clparser = argparse.ArgumentParser(description='Benchmark the import ' +
+            'time of hefind.')
+    clparser.add_argument('--budget', type=float, default=300., metavar='MS',
+            help='maximum import time in milliseconds (default: 300)')
+    clparser.add_argument('--repeat', type=int, default=5, metavar='N',
+            help='number of imports; the fastest is kept (default: 5)')
+    clparser.add_argument('--module', default='hefind',
+            help='module to import (default: hefind)')
+    args = clparser.parse_args(argv)
+
+    runs = [import_times(args.module) for i in range(args.repeat)]
+    times = min(runs, key=lambda times: times[args.module])
+    total = times[args.module] / 1e3
+    print('Slowest imports (cumulative ms):')
+    slowest = sorted(times.items(), key=lambda item: -item[1])[:10]
+    for name, cumulative in slowest:
+        print('  {:<40} {:>8.1f}'.format(name, cumulative / 1e3))
+
+    failed = False
+    forbidden = sorted(set(name.split('.')[0] for name in times
+                           if name.split('.')[0] in FORBIDDEN))
+    if forbidden:
+        failed = True
+        print('FAIL: {} imports {}'.format(args.module, ', '.join(forbidden)))
+    if total > args.budget:
+        failed = True
+        print('FAIL: importing {} takes {:.1f} ms, budget is {:.1f} ms'
+              .format(args.module, total, args.budget))
+    else:
+        print('OK: importing {} takes {:.1f} ms, budget is {:.1f} ms'.format(
+              args.module, total, args.budget))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
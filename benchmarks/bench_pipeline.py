@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time every stage of sloany and hefind on synthetic spectra: query, fetch,
+FITS extraction, text and binary output, loading, smoothing, noise
+estimation, baseline correction, line detection and screening.
+
+The spectra, their lite FITS files and a local fake skyserver and spectra
+mirror are generated by the synthetic module. For each stage, the best time
+over a few runs, the throughput and the peak memory allocated (traced in a
+separate run) are reported.
+
+Usage::
+
+    python benchmarks/bench_pipeline.py [-n NB_SPECTRA] [--save FILE]
+        [--compare FILE] [--tolerance FRACTION] [STAGE ...]
+
+With ``--save``, the results are stored as JSON to serve as a baseline for
+later runs with ``--compare``. Stages that got slower than the baseline by
+more than the tolerance are flagged and the exit status is then 1.
+
+"""
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import hefind
+import sloany
+import specstore
+
+import synthetic
+
+
+QUERY = ('select s.plate,s.mjd,s.fiberid,s.run2d,s.ra,s.dec from '
+         'bestdr9..SpecObj as s where s.class = STAR')
+
+
+def prepare(workdir, nb_spectra, seed):
+    """Generate the data for all the stages in workdir and return a dict of
+    everything the stages need."""
+    root = os.path.join(workdir, 'sas')
+    objects, helium = synthetic.write_fits_files(root, nb_spectra, seed=seed)
+    data = {'root': root, 'objects': objects, 'helium': helium}
+    fitsdir = os.path.join(workdir, 'fits')
+    os.makedirs(fitsdir)
+    data['fitsfiles'] = []
+    data['downloads'] = []
+    for obj in objects:
+        specfile = sloany.specfile_name(obj)
+        path = '/{:04d}/{}'.format(obj['plate'], specfile)
+        fitsfile = os.path.join(fitsdir, specfile)
+        shutil.copy(os.path.join(root, obj['run2d']) + path, fitsfile)
+        data['fitsfiles'].append(fitsfile)
+        data['downloads'].append(
+            (obj['run2d'], path, os.path.join(workdir, 'fetched', specfile)))
+    os.makedirs(os.path.join(workdir, 'fetched'))
+
+    spectra = [sloany.extract_spectrum_buffer(open(fname, 'rb').read())
+               for fname in data['fitsfiles']]
+    data['spectra'] = spectra
+    data['textdir'] = os.path.join(workdir, 'reduced')
+    os.makedirs(data['textdir'])
+    data['textfiles'] = [os.path.join(data['textdir'], 'J{:04d}'.format(i))
+                         for i in range(nb_spectra)]
+    for fname, (wavs, fluxes) in zip(data['textfiles'], spectra):
+        sloany.write_flux(fname, wavs, fluxes)
+    data['store'] = os.path.join(workdir, 'store')
+    with specstore.SpectrumStore(data['store'], 'a') as store:
+        for fname, (wavs, fluxes) in zip(data['textfiles'], spectra):
+            store.add(os.path.basename(fname), wavs, fluxes)
+
+    data['fluxes'] = [fluxes.astype(float) for wavs, fluxes in spectra]
+    data['smoothed'] = [hefind.smooth_spectrum(fluxes)
+                        for fluxes in data['fluxes']]
+    data['corrected'] = [hefind.baseline(smoothed)
+                         for smoothed in data['smoothed']]
+    data['noise'] = [hefind.estimate_noise(fluxes, smoothed)
+                     for fluxes, smoothed in zip(data['fluxes'],
+                                                 data['smoothed'])]
+    return data
+
+
+def make_stages(data, workdir, server):
+    """Return an ordered dict mapping the name of each stage to a function
+    running it on all the spectra."""
+    stages = collections.OrderedDict()
+
+    def query():
+        sloany.skyserver_url = server.url
+        return list(sloany.iter_query(QUERY))
+
+    def fetch():
+        with contextlib.redirect_stdout(io.StringIO()):
+            failed = sloany.download_files(
+                data['downloads'], jobs=4,
+                mirrors=sloany.MirrorPool([server.mirror]))
+        if failed:
+            raise RuntimeError('{} downloads failed'.format(len(failed)))
+
+    def read_list():
+        for fname in data['textfiles']:
+            with open(fname) as f:
+                nb_wavs = int(f.readline().split()[0])
+                hefind.read_list(f, nb_wavs)
+                hefind.read_list(f, nb_wavs)
+
+    def write_store():
+        path = os.path.join(workdir, 'store-bench')
+        shutil.rmtree(path, ignore_errors=True)
+        with specstore.SpectrumStore(path, 'a') as store:
+            for fname, (wavs, fluxes) in zip(data['textfiles'],
+                                             data['spectra']):
+                store.add(os.path.basename(fname), wavs, fluxes)
+
+    def load_store():
+        with specstore.SpectrumStore(data['store']) as store:
+            for name in store:
+                wavs, fluxes = store.get(name)
+                fluxes.sum()
+
+    stages['query'] = query
+    stages['fetch'] = fetch
+    stages['extract'] = lambda: [sloany.extract_spectrum(fname)
+                                 for fname in data['fitsfiles']]
+    stages['extract-buffer'] = lambda: [
+        sloany.extract_spectrum_buffer(open(fname, 'rb').read())
+        for fname in data['fitsfiles']]
+    stages['write_flux'] = lambda: [
+        sloany.write_flux(fname, wavs, fluxes)
+        for fname, (wavs, fluxes) in zip(data['textfiles'], data['spectra'])]
+    stages['write-store'] = write_store
+    stages['read_list'] = read_list
+    stages['load'] = lambda: [hefind.load_spectrum(fname)
+                              for fname in data['textfiles']]
+    stages['load-store'] = load_store
+    stages['smooth'] = lambda: [hefind.smooth_spectrum(fluxes)
+                                for fluxes in data['fluxes']]
+    stages['noise'] = lambda: [
+        hefind.estimate_noise(fluxes, smoothed)
+        for fluxes, smoothed in zip(data['fluxes'], data['smoothed'])]
+    stages['baseline'] = lambda: [hefind.baseline(smoothed)
+                                  for smoothed in data['smoothed']]
+    stages['detect'] = lambda: [
+        hefind.find_lines(fluxes, smoothed, corrected, noise=noise)
+        for fluxes, smoothed, corrected, noise in zip(
+            data['fluxes'], data['smoothed'], data['corrected'],
+            data['noise'])]
+    stages['screen'] = lambda: [hefind.find_helium(fname)
+                                for fname in data['textfiles']]
+    stages['screen-stack'] = lambda: hefind.find_helium_batch(
+        data['textfiles'])
+    return stages
+
+
+def measure(func, nb_items, repeat):
+    """Return the measurements for func, which processes nb_items items."""
+    seconds = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': seconds, 'ms_per_item': 1e3 * seconds / nb_items,
+            'items_per_s': nb_items / seconds, 'peak_mb': peak / 2.**20}
+
+
+def detection(data):
+    """Return the helium detection counts on the synthetic spectra."""
+    candidates = numpy.array([hefind.find_helium(fname).is_candidate
+                              for fname in data['textfiles']])
+    helium = data['helium']
+    return {'helium': int(helium.sum()),
+            'true_positives': int((candidates & helium).sum()),
+            'false_positives': int((candidates & ~helium).sum())}
+
+
+def main(argv=sys.argv[1:]):
+    clparser = argparse.ArgumentParser(description='Benchmark the stages ' +
+            'of sloany and hefind on synthetic spectra.')
+    clparser.add_argument('stages', nargs='*', metavar='STAGE',
+            help='stages to run (default: all)')
+    clparser.add_argument('-n', '--nb-spectra', type=int, default=200,
+            help='number of synthetic spectra (default: 200)')
+    clparser.add_argument('--repeat', type=int, default=3,
+            help='number of timed runs per stage; the fastest is kept ' +
+            '(default: 3)')
+    clparser.add_argument('--seed', type=int, default=0,
+            help='seed of the synthetic spectra (default: 0)')
+    clparser.add_argument('--delay', type=float, default=0.,
+            help='latency in seconds added to each request to the fake ' +
+            'server (default: 0)')
+    clparser.add_argument('--save', metavar='FILE',
+            help='save the results to FILE, in JSON')
+    clparser.add_argument('--compare', metavar='FILE',
+            help='compare with the results saved in FILE')
+    clparser.add_argument('--tolerance', type=float, default=0.2,
+            help='relative slow down above which a stage is flagged as a ' +
+            'regression (default: 0.2)')
+    args = clparser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='sloany-bench-')
+    try:
+        data = prepare(workdir, args.nb_spectra, args.seed)
+        with synthetic.FakeSDSSServer(data['root'], data['objects'],
+                                      args.delay) as server:
+            stages = make_stages(data, workdir, server)
+            unknown = set(args.stages) - set(stages)
+            if unknown:
+                clparser.error('unknown stages: {} (choose from {})'.format(
+                    ', '.join(sorted(unknown)), ', '.join(stages)))
+            results = collections.OrderedDict()
+            for name, func in stages.items():
+                if not args.stages or name in args.stages:
+                    results[name] = measure(func, args.nb_spectra,
+                                            args.repeat)
+        quality = detection(data)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['stages']
+    print('{:<15} {:>10} {:>12} {:>12} {:>9} {:>9}'.format(
+        'stage', 'total s', 'ms/spectrum', 'spectra/s', 'peak MB',
+        'change'))
+    regressions = []
+    for name, result in results.items():
+        change = ''
+        if name in baseline:
+            ratio = result['ms_per_item'] / baseline[name]['ms_per_item'] - 1
+            change = '{:+.0%}'.format(ratio)
+            if ratio > args.tolerance:
+                regressions.append(name)
+                change += ' !'
+        print('{:<15} {:>10.3f} {:>12.3f} {:>12.1f} {:>9.1f} {:>9}'.format(
+            name, result['seconds'], result['ms_per_item'],
+            result['items_per_s'], result['peak_mb'], change))
+    print('Helium detected in {true_positives} of {helium} spectra with '
+          'helium lines, {false_positives} false positives.'.format(
+              **quality))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'nb_spectra': args.nb_spectra,
+                       'python': platform.python_version(),
+                       'numpy': numpy.__version__,
+                       'platform': platform.platform(),
+                       'detection': quality, 'stages': results}, f,
+                      indent=2)
+    if regressions:
+        print('REGRESSION: {} slower than the baseline by more than '
+              '{:.0%}.'.format(', '.join(regressions), args.tolerance))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic data for the benchmarks: SDSS-like white dwarf spectra with
+hydrogen and, for some of them, helium absorption lines, lite spectrum FITS
+files and a local HTTP server standing in for the skyserver and the SAS
+spectra mirrors.
+
+"""
+
+import csv
+import http.server as server
+import io
+import os
+import sys
+import threading
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import hefind
+
+
+LOGLAM_START = 3.5800
+LOGLAM_STEP = 1e-4
+NB_PTS = 4600
+RUN2D = '26'
+# Columns of the coadd HDU of the SDSS lite spectra.
+COADD_COLUMNS = ['flux', 'loglam', 'ivar', 'and_mask', 'or_mask', 'wdisp',
+                 'sky', 'model']
+
+
+def synthetic_spectra(nb_spectra, nb_pts=NB_PTS, helium_fraction=0.3,
+                      seed=0):
+    """Return a tuple (loglam, fluxes, ivar, helium) for ``nb_spectra``
+    synthetic spectra on the SDSS log-lambda grid.
+
+    Every spectrum has a power law continuum with Balmer lines. A fraction
+    ``helium_fraction`` of them also have He I and He II lines, as flagged by
+    the boolean array ``helium``. The noise follows the photon noise of the
+    continuum plus a read noise, and ``ivar`` is its inverse variance.
+
+    """
+    rng = numpy.random.RandomState(seed)
+    loglam = LOGLAM_START + LOGLAM_STEP * numpy.arange(nb_pts)
+    wavs = 10**loglam
+    scale = rng.uniform(20., 200., (nb_spectra, 1))
+    slope = rng.uniform(-3., -1., (nb_spectra, 1))
+    continuum = scale * (wavs / 5000.)**slope
+    absorption = numpy.zeros((nb_spectra, nb_pts))
+    for line in hefind.HYDROGEN_LINES:
+        depth = rng.uniform(0.05, 0.4, (nb_spectra, 1))
+        width = rng.uniform(8., 20., (nb_spectra, 1))
+        absorption += depth * numpy.exp(-0.5 * ((wavs - line) / width)**2)
+    helium = rng.uniform(size=nb_spectra) < helium_fraction
+    for line in hefind.HELIUM_LINES:
+        depth = rng.uniform(0.1, 0.4, (nb_spectra, 1)) * helium[:, None]
+        width = rng.uniform(4., 10., (nb_spectra, 1))
+        absorption += depth * numpy.exp(-0.5 * ((wavs - line) / width)**2)
+    model = continuum * numpy.maximum(1. - absorption, 0.)
+    sigma = numpy.sqrt(0.05 * model + 1.)
+    fluxes = model + sigma * rng.normal(size=model.shape)
+    return (loglam.astype(numpy.float32), fluxes.astype(numpy.float32),
+            (1. / sigma**2).astype(numpy.float32), helium)
+
+
+def _card(key, value):
+    """Return a FITS header card."""
+    if isinstance(value, bool):
+        value = '{:>20}'.format('T' if value else 'F')
+    elif isinstance(value, str):
+        value = "{:<20}".format("'{:<8}'".format(value.replace("'", "''")))
+    else:
+        value = '{:>20}'.format(value)
+    return '{:<8}= {}'.format(key, value).ljust(80)
+
+
+def _header(cards):
+    """Return a FITS header made of cards, padded to a whole block."""
+    text = ''.join(cards) + 'END'.ljust(80)
+    return (text + ' ' * (-len(text) % 2880)).encode('ascii')
+
+
+def fits_bytes(loglam, flux, ivar):
+    """Return the content of a lite spectrum FITS file: an empty primary HDU
+    followed by the coadd binary table."""
+    nb_pts = len(loglam)
+    rows = numpy.zeros(nb_pts, [(name, '>i4' if name.endswith('mask')
+                                 else '>f4') for name in COADD_COLUMNS])
+    rows['flux'] = flux
+    rows['loglam'] = loglam
+    rows['ivar'] = ivar
+    rows['wdisp'] = 1.
+    rows['model'] = flux
+    cards = [_card('XTENSION', 'BINTABLE'), _card('BITPIX', 8),
+             _card('NAXIS', 2), _card('NAXIS1', rows.dtype.itemsize),
+             _card('NAXIS2', nb_pts), _card('PCOUNT', 0),
+             _card('GCOUNT', 1), _card('TFIELDS', len(COADD_COLUMNS)),
+             _card('EXTNAME', 'COADD')]
+    for i, name in enumerate(COADD_COLUMNS, 1):
+        cards.append(_card('TTYPE{}'.format(i), name))
+        cards.append(_card('TFORM{}'.format(i),
+                           'J' if name.endswith('mask') else 'E'))
+    data = rows.tobytes()
+    return (_header([_card('SIMPLE', True), _card('BITPIX', 8),
+                     _card('NAXIS', 0), _card('EXTEND', True)]) +
+            _header(cards) + data + b'\0' * (-len(data) % 2880))
+
+
+def write_fits_files(root, nb_spectra, helium_fraction=0.3, seed=0,
+                     plate=4000, mjd=55000):
+    """Write ``nb_spectra`` synthetic lite spectra under ``root`` with the
+    layout of the SAS mirrors (RUN2D/PLATE/spec-PLATE-MJD-FIBER.fits).
+
+    Return the list of objects, as dicts with the columns a query would
+    select (plate, mjd, fiberid, run2d, ra, dec), and the array telling which
+    spectra have helium lines.
+
+    """
+    loglam, fluxes, ivar, helium = synthetic_spectra(
+        nb_spectra, helium_fraction=helium_fraction, seed=seed)
+    folder = os.path.join(root, RUN2D, '{:04d}'.format(plate))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    rng = numpy.random.RandomState(seed)
+    objects = []
+    for fiber in range(nb_spectra):
+        fname = 'spec-{:04d}-{:05d}-{:04d}.fits'.format(plate, mjd, fiber)
+        with open(os.path.join(folder, fname), 'wb') as f:
+            f.write(fits_bytes(loglam, fluxes[fiber], ivar[fiber]))
+        objects.append({'plate': plate, 'mjd': mjd, 'fiberid': fiber,
+                        'run2d': RUN2D, 'ra': rng.uniform(0., 360.),
+                        'dec': rng.uniform(-10., 60.)})
+    return objects, helium
+
+
+class LocalServer(object):
+    """Local HTTP server answering requests with ``handler``, a subclass of
+    http.server.BaseHTTPRequestHandler, in a background thread.
+
+    Use as a context manager; ``base_url`` is the URL of the server, e.g.,
+    http://127.0.0.1:PORT.
+
+    """
+
+    def __init__(self, handler):
+        self.httpd = server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        host, port = self.httpd.server_address[:2]
+        self.base_url = 'http://{}:{}'.format(host, port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeSDSSServer(LocalServer):
+    """Local HTTP server answering every skyserver query (path /x_sql.asp)
+    with the CSV of ``objects`` and serving the files under ``root`` as a
+    spectra mirror (path /sas/RUN2D/...). Each request is delayed by
+    ``delay`` seconds to simulate the network latency.
+
+    Use as a context manager; ``url`` is the skyserver URL and ``mirror``
+    the mirror URL, with %s in place of run2d.
+
+    """
+
+    def __init__(self, root, objects, delay=0.):
+        columns = ['plate', 'mjd', 'fiberid', 'run2d', 'ra', 'dec']
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(columns)
+        for obj in objects:
+            writer.writerow([obj[column] for column in columns])
+        csv_body = out.getvalue().encode('utf-8')
+
+        class Handler(server.SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def translate_path(self, path):
+                path = path.split('?')[0]
+                if path.startswith('/sas/'):
+                    path = path[len('/sas'):]
+                return os.path.join(root, *path.strip('/').split('/'))
+
+            def do_GET(self):
+                if delay:
+                    time.sleep(delay)
+                if self.path.startswith('/x_sql.asp'):
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain')
+                    self.send_header('Content-Length', str(len(csv_body)))
+                    self.end_headers()
+                    self.wfile.write(csv_body)
+                else:
+                    super(Handler, self).do_GET()
+
+        super(FakeSDSSServer, self).__init__(Handler)
+        self.url = self.base_url + '/x_sql.asp'
+        self.mirror = self.base_url + '/sas/%s'
@@ -19,12 +19,21 @@ __version__ = '0.1dev'
 
 
 import argparse
-import matplotlib.pyplot as plt
+import collections
+import csv
+import functools
+import hashlib
+import instrument
+import io
+import itertools
+import json
 import numpy
+import multiprocessing
 import os
-import scipy
-import scipy.ndimage.morphology
+import specstore
+import sqlite3
 import sys
+import time
 
 
 # The 3888.65 He I line is very close to lots of strong lines for other
@@ -32,6 +41,124 @@ import sys
 HELIUM_I_LINES = [3888.65, 4471.5, 5015.678, 5875.6404, 6678.1517, 7065.2153]
 HELIUM_II_LINES = [4685.7]
 HELIUM_LINES = HELIUM_I_LINES + HELIUM_II_LINES
+HYDROGEN_LINES = [4101.734, 4340.462, 4861.325, 6562.801]
+CALCIUM_II_LINES = [3933.663, 3968.469]
+
+# White dwarf spectral types and the species whose lines define them.
+SPECTRAL_TYPES = [('DA', ('HI',)), ('DB', ('HeI', 'HeII')), ('DZ', ('CaII',))]
+
+
+class LineCatalog(object):
+    """Catalog of spectral lines to match against the lines of a spectrum.
+
+    ``lines`` is a list of triples (wavelength, species, weight). A line of
+    the spectrum matches the nearest line of the catalog if their wavelengths
+    differ by less than ``tolerance`` angstroms. The nearest lines are found
+    by binary search in the sorted catalog wavelengths.
+
+    """
+
+    def __init__(self, lines, tolerance=5.):
+        lines = sorted(lines)
+        self.wavelengths = numpy.array([line[0] for line in lines],
+                                       dtype=float)
+        self.species = [line[1] for line in lines]
+        self.weights = numpy.array([line[2] for line in lines], dtype=float)
+        self.tolerance = tolerance
+
+    @classmethod
+    def from_file(cls, fname, tolerance=5.):
+        """Read a catalog from a text file with one line per row: wavelength,
+        species (e.g. HeI, without spaces) and optional weight, separated by
+        whitespace. Lines starting with # are ignored."""
+        lines = []
+        for row in open(fname):
+            fields = row.split('#')[0].split()
+            if fields:
+                weight = float(fields[2]) if len(fields) > 2 else 1.
+                lines.append((float(fields[0]), fields[1], weight))
+        return cls(lines, tolerance)
+
+    def __len__(self):
+        return len(self.wavelengths)
+
+    def match(self, wavs):
+        """Match the wavelengths wavs against the catalog.
+
+        Return a pair of integer arrays (indices in wavs, indices in the
+        catalog) for the wavelengths that match a catalog line.
+
+        """
+        wavs = numpy.asarray(wavs, dtype=float)
+        if not len(self) or not len(wavs):
+            return (numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int))
+        # The nearest catalog line is on either side of the insertion point.
+        right = numpy.minimum(numpy.searchsorted(self.wavelengths, wavs),
+                              len(self) - 1)
+        left = numpy.maximum(right - 1, 0)
+        closer_left = (numpy.abs(wavs - self.wavelengths[left]) <=
+                       numpy.abs(wavs - self.wavelengths[right]))
+        nearest = numpy.where(closer_left, left, right)
+        matched = numpy.flatnonzero(
+            numpy.abs(wavs - self.wavelengths[nearest]) < self.tolerance)
+        return matched, nearest[matched]
+
+    def classify(self, species, min_score=2.):
+        """Return the spectral types (see SPECTRAL_TYPES) for which the
+        matched lines of the given species have a total weight of at least
+        ``min_score``. ``species`` is the list of pairs (species, weight)
+        of the matched lines."""
+        types = []
+        for sptype, type_species in SPECTRAL_TYPES:
+            score = sum(weight for name, weight in species
+                        if name in type_species)
+            if score >= min_score:
+                types.append(sptype)
+        return types
+
+
+HELIUM_CATALOG = ([(line, 'HeI', 1.) for line in HELIUM_I_LINES] +
+                  [(line, 'HeII', 1.) for line in HELIUM_II_LINES])
+CATALOGS = {
+    'helium': HELIUM_CATALOG,
+    'wd': (HELIUM_CATALOG + [(line, 'HI', 1.) for line in HYDROGEN_LINES] +
+           [(line, 'CaII', 1.) for line in CALCIUM_II_LINES]),
+}
+
+
+def load_catalog(name, tolerance=5.):
+    """Return the LineCatalog for name, which is either the name of a built-in
+    catalog (see CATALOGS) or the name of a catalog file."""
+    if name in CATALOGS:
+        return LineCatalog(CATALOGS[name], tolerance)
+    return LineCatalog.from_file(name, tolerance)
+
+
+class HeliumResult(collections.namedtuple('HeliumResult',
+        ['fname', 'lines', 'matches', 'types', 'noise', 'error'])):
+    """Outcome of the search for helium in the spectrum file ``fname``.
+
+    ``lines`` is the list of pairs (wavelength, signal to noise ratio) for all
+    the lines found in the spectrum and ``matches`` the list of 4-tuples
+    (wavelength, signal to noise ratio, catalog line, species) for those that
+    match a line of the catalog. ``types`` is the list of spectral types
+    supported by the matches, e.g., ['DB'] when helium is found. ``noise`` is
+    the median noise level of the spectrum. ``error`` is None unless the
+    spectrum could not be processed, in which case it is the error message.
+
+    """
+    __slots__ = ()
+
+    @property
+    def is_candidate(self):
+        """True if the spectrum was classified in a spectral type, i.e., with
+        the default catalog, if at least two helium lines were found."""
+        return self.error is None and bool(self.types)
+
+    @property
+    def max_sn(self):
+        """Largest signal to noise ratio of the matched lines."""
+        return max([match[1] for match in self.matches] or [0.])
 
 
 def read_list(f, nb_freqs):
@@ -60,22 +187,82 @@ def read_list(f, nb_freqs):
     return numpy.array(alist)
 
 
-def plot_spectrum(freqs, fluxes, min_lambda=3700, max_lambda=8000):
-    """Plot the flux as a function of frequency."""
-    plt.plot(freqs, fluxes)
-    plt.xlim((min_lambda, max_lambda))
-    plt.xlabel(r'$\lambda\, (\AA)$', size=16)
-    plt.ylabel(r'$Flux$', size=16)
-    #plt.axes().minorticks_on()
+def read_spectrum(f):
+    """Read a spectrum in the format understood by fitchi2 from file f and
+    return the arrays of wavelengths and fluxes.
 
+    Spectra written by sloany (10 wavelengths per line, then 6 fluxes per
+    line) are parsed in bulk, including flux lines where values run together.
+    Other layouts are parsed with read_list.
 
-def make_spectrum_figure(f):
-    """Create a figure showing spectrum contained in file f."""
-    nb_freqs = int(f.readline().split()[0])
-    freqs = read_list(f, nb_freqs)
-    fluxes = read_list(f, nb_freqs)
-    plot_spectrum(freqs, fluxes)
-    plt.show()
+    """
+    nb_wavs = int(f.readline().split()[0])
+    text = f.read()
+
+    # Usual case: the values are all separated by whitespace.
+    tokens = text.split()
+    if len(tokens) == 2 * nb_wavs:
+        try:
+            values = numpy.array(tokens, dtype=float)
+            return values[:nb_wavs], values[nb_wavs:]
+        except ValueError:
+            pass
+
+    # Fluxes may run together when there are negative values. Fluxes are
+    # then read as fixed width fields of 12 characters.
+    lines = text.splitlines()
+    nb_wav_lines = -(-nb_wavs // 10)
+    nb_flux_lines = -(-nb_wavs // 6)
+    wav_tokens = ' '.join(lines[:nb_wav_lines]).split()
+    flux_lines = lines[nb_wav_lines:nb_wav_lines + nb_flux_lines]
+    last_width = 12 * (nb_wavs % 6 or 6)
+    if (len(wav_tokens) == nb_wavs and len(flux_lines) == nb_flux_lines and
+            all(len(line) == 72 for line in flux_lines[:-1]) and
+            len(flux_lines[-1]) == last_width):
+        try:
+            wavs = numpy.array(wav_tokens, dtype=float)
+            fluxes = numpy.frombuffer(''.join(flux_lines).encode('ascii'),
+                                      dtype='S12').astype(float)
+            return wavs, fluxes
+        except (ValueError, UnicodeEncodeError):
+            pass
+
+    f = io.StringIO(text)
+    wavs = read_list(f, nb_wavs)
+    fluxes = read_list(f, nb_wavs)
+    return wavs, fluxes
+
+
+_stores = {}
+
+
+def load_spectrum(fname):
+    """Return the arrays of wavelengths and fluxes of the spectrum file
+    fname.
+
+    ``fname`` may also be STORE/NAME for the spectrum NAME of the spectrum
+    store STORE (see specstore), which is read without copying the data.
+
+    """
+    store, name = _store_member(fname)
+    if store is not None:
+        return store.get(name)
+    with open(fname) as f:
+        return read_spectrum(f)
+
+
+def _store_member(fname):
+    """Return the pair (store, name) if fname is STORE/NAME for a spectrum of
+    a spectrum store, or (None, fname) otherwise. Stores are opened once."""
+    store_path, name = os.path.split(fname)
+    if not store_path or not specstore.is_store(store_path):
+        return None, fname
+    store = _stores.get(store_path)
+    if store is None:
+        store = _stores[store_path] = specstore.SpectrumStore(store_path)
+    if name not in store:
+        raise IOError('no spectrum {} in store {}'.format(name, store_path))
+    return store, name
 
 
 def find_centers(line_complex):
@@ -88,132 +275,788 @@ def find_centers(line_complex):
     return zero_crossings + 1
 
 
+def moving_average(y, window_width):
+    """Return the average of ``y`` over a window of ``window_width`` points
+    (an odd number) centered on each point along the last axis. The data is
+    reflected at the edges, so the result has the same shape as ``y``.
+
+    Uses a cumulative sum: the cost does not depend on the size of the
+    window.
+
+    """
+    half_width = window_width // 2
+    pad = [(0, 0)] * (y.ndim - 1) + [(half_width, half_width)]
+    sums = numpy.cumsum(numpy.pad(y, pad, mode='reflect'), axis=-1)
+    average = sums[..., window_width - 1:].copy()
+    average[..., 1:] -= sums[..., :-window_width]
+    average /= window_width
+    return average
+
+
+def estimate_noise(fluxes, smoothed, fraction_pts=0.2):
+    """Estimate the noise in the spectrum ``fluxes`` given its smoothed
+    version ``smoothed``.
+
+    Return a pair of arrays (residual, noise) with the same shape as
+    ``fluxes``. The residual is the absolute difference between the spectrum
+    and its smoothed version and the noise is the average residual over a
+    window covering ``fraction_pts`` of the spectrum.
+
+    ``fluxes`` may also be a 2-D array with one spectrum per row.
+
+    """
+    window_width = int(fluxes.shape[-1] * fraction_pts / 2) * 2 + 1
+    # Residual decribes the noise.
+    residual = numpy.abs(fluxes - smoothed)
+    # The noise is the average residual over a window of width
+    # ``window_width``.  noise has same length as fluxes
+    return residual, moving_average(residual, window_width)
+
+
+def line_centers(corrected, below):
+    """Return the indices of the line centers in the corrected spectrum
+    ``corrected``, where ``below`` is true for the points in a line complex.
+
+    The indices are returned as by numpy.nonzero, as a tuple with one array
+    per dimension of ``corrected``, which may be a 2-D array with one
+    spectrum per row.
+
+    """
+    # The line centers are the points of a complex where the flux is at a
+    # minimum, i.e., the second derivative is positive (see find_centers).
+    # The point and its two neighbours must belong to the complex.
+    diff2 = numpy.diff(numpy.sign(numpy.diff(corrected)))
+    centers = numpy.nonzero(below[..., :-2] & below[..., 1:-1] &
+                            below[..., 2:] & (diff2 > 0.))
+    return centers[:-1] + (centers[-1] + 1,)
+
+
 def find_lines(fluxes, smoothed, corrected, threshold=1., fraction_pts=0.2,
-        wavs=None, plot=False):
+        wavs=None, plot=False, noise=None):
     """Find all the spectral lines (i.e., valleys) in the spectrum ``fluxes``
     given a corrected version of the spectrum ``corrected``.
 
+    ``noise`` is the pair (residual, noise) returned by estimate_noise; it is
+    computed if not given. With ``plot``, the lines are shown with heplot.
+
     Return a list of pairs (line center index, signal to noise ratio for the
     line).
     """
-    line_indices = []
-    window_width = int(len(fluxes) * fraction_pts / 2) * 2 + 1
-    half_width = window_width // 2
-    # Reflect the endpoints of the spectrum.
-    x = numpy.concatenate((fluxes[half_width:0:-1], fluxes,
-        fluxes[-2:-half_width - 2:-1]))
-    xs = numpy.concatenate((smoothed[half_width:0:-1], smoothed,
-                           smoothed[-2:-half_width - 2:-1]))
-    # Residual decribes the noise.
-    residual = numpy.abs(x - xs)
-    # The noise is the average residual over a window of width
-    # ``window_width``.  noise has same length as fluxes
-    noise = numpy.convolve(residual, numpy.ones(window_width) / window_width,
-                           'valid')
+    if noise is None:
+        noise = estimate_noise(fluxes, smoothed, fraction_pts)
+    residual, noise = noise
+
+    # A line complex is a run of points where the flux value is smaller than
+    # ``threshold`` times the average noise.
+    below = corrected < -threshold * noise
+
+    centers, = line_centers(corrected, below)
+
+    # Calculate signal to noise ratio for the lines.
+    sn = residual[centers] / noise[centers]
+    line_indices = list(zip(centers.tolist(), sn.tolist()))
 
     # If the plot flag is on, show the line complex and the lines that are
     # found.
     if plot:
+        import heplot
         if wavs is None:
-            wavs = range(len(fluxes))
-        plt.plot(wavs, corrected, wavs, -noise)
-
-    # A line complex is found if the flux value is smaller than ``threshold``
-    # times the average noise.
-    pos = 0
-    max_pos = len(corrected)
-    while pos < max_pos:
-        min_pos = pos # Lowest index for line
-        while (pos < max_pos and corrected[pos] < -threshold * noise[pos]):
-            pos += 1
-        # Check if a line complex has been found
-        if pos > min_pos:
-            if plot:
-                plt.axvspan(wavs[min_pos], wavs[pos - 1], color='g', alpha=0.1)
-            # Find the line center for each line in the complex.
-            centers = min_pos + find_centers(corrected[min_pos:pos])
-
-            # Calculate signal to noise ratio for the line.
-            for center in centers:
-                sn = residual[center + half_width] / noise[center]
-                line_indices.append((center, sn))
-        pos += 1
+            wavs = numpy.arange(len(fluxes))
+        heplot.plot_lines(wavs, corrected, noise, below, line_indices)
+
+    return line_indices
 
-    if plot:
-        for line, sn in line_indices:
-            plt.axvline(x=wavs[line], color='r', alpha=0.3, linewidth=2)
-        plt.show()
 
+def find_lines_batch(fluxes, smoothed, corrected, threshold=1.,
+        fraction_pts=0.2, noise=None):
+    """Find the spectral lines in each row of the 2-D array ``fluxes``, like
+    find_lines, without plotting.
+
+    Return a list with, for each spectrum, the list of pairs (line center
+    index, signal to noise ratio for the line).
+    """
+    if noise is None:
+        noise = estimate_noise(fluxes, smoothed, fraction_pts)
+    residual, noise = noise
+    below = corrected < -threshold * noise
+    rows, centers = line_centers(corrected, below)
+    sn = residual[rows, centers] / noise[rows, centers]
+    line_indices = [[] for i in range(len(fluxes))]
+    for row, center, ratio in zip(rows.tolist(), centers.tolist(),
+                                  sn.tolist()):
+        line_indices[row].append((center, ratio))
     return line_indices
 
 
-def baseline(fluxes, fraction_pts=0.2):
+def baseline_tophat(fluxes, fraction_pts=0.2):
     """Correct the baseline of the spectrum whose ordinate values are in
     ``fluxes``. Baseline correction uses the white top hat algorithm."""
-    nb_pts = fraction_pts * len(fluxes)
+    nb_pts = int(fraction_pts * fluxes.shape[-1])
     # Top hat fits the lowest values. Since most spectrum have
     # absorption lines and that the continuum plays the role of baseline, the
     # flux must first be reflected along the abscissa.
+    import scipy.ndimage
     y = -fluxes
-    structure = numpy.ones(nb_pts)
-    z = scipy.ndimage.morphology.white_tophat(y, structure=structure,
-                                              mode='reflect')
+    structure = numpy.ones((1,) * (y.ndim - 1) + (nb_pts,))
+    z = scipy.ndimage.white_tophat(y, structure=structure, mode='reflect')
 
     # Reflect the baseline corrected flux and return it.
     return -z
 
 
-def smooth_spectrum(fluxes, window_width=7, passes=3):
-    """Produce a smoothed version of the spectra using a sliding window
-    approach."""
-    smoothed = numpy.array(fluxes)
+def running_extremum(y, size, func):
+    """Return the minimum (func is numpy.minimum) or maximum (func is
+    numpy.maximum) of y over all windows of ``size`` points along the last
+    axis. Element i of the result is for window y[..., i:i + size].
+
+    Uses the van Herk/Gil-Werman algorithm: the cost does not depend on the
+    size of the window.
+
+    """
+    fill = numpy.inf if func is numpy.minimum else -numpy.inf
+    n = y.shape[-1]
+    nb_blocks = -(-n // size)
+    shape = y.shape[:-1] + (nb_blocks * size,)
+    blocks = numpy.concatenate(
+        (y, numpy.full(y.shape[:-1] + (nb_blocks * size - n,), fill)),
+        axis=-1).reshape(y.shape[:-1] + (nb_blocks, size))
+    # Running extremum from the start and from the end of each block. A
+    # window overlaps at most two blocks: its extremum is that of the end of
+    # the first one and the start of the second one.
+    prefix = func.accumulate(blocks, axis=-1).reshape(shape)
+    suffix = func.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1]
+    suffix = suffix.reshape(shape)
+    nb_windows = n - size + 1
+    return func(suffix[..., :nb_windows],
+                prefix[..., size - 1:size - 1 + nb_windows])
+
+
+def baseline_fast_tophat(fluxes, fraction_pts=0.2):
+    """Correct the baseline of the spectrum whose ordinate values are in
+    ``fluxes`` with the white top hat algorithm, like baseline_tophat, but in
+    a time that does not depend on the size of the structuring element.
+
+    ``fluxes`` may also be a 2-D array with one spectrum per row.
+
+    """
+    nb_pts = max(1, int(fraction_pts * fluxes.shape[-1]))
+    pad = [(0, 0)] * (fluxes.ndim - 1)
+    # The white top hat of -fluxes is -fluxes minus its opening (an erosion
+    # followed by a dilation), which is fluxes minus its closing. The windows
+    # are placed as in scipy.ndimage, which reflects the data at the edges.
+    left = nb_pts // 2
+    padded = numpy.pad(fluxes, pad + [(left, nb_pts - 1 - left)],
+                       mode='symmetric')
+    dilated = running_extremum(padded, nb_pts, numpy.maximum)
+    left = (nb_pts - 1) // 2
+    padded = numpy.pad(dilated, pad + [(left, nb_pts - 1 - left)],
+                       mode='symmetric')
+    closing = running_extremum(padded, nb_pts, numpy.minimum)
+    return fluxes - closing
+
+
+def baseline_poly(fluxes, degree=7, iterations=20):
+    """Correct the baseline of the spectrum whose ordinate values are in
+    ``fluxes`` by fitting a polynomial to the continuum.
+
+    The polynomial is fitted iteratively: at each step, the points below the
+    previous fit (the absorption lines) are replaced by the fit.
+
+    """
+    if fluxes.ndim > 1:
+        return numpy.array([baseline_poly(row, degree, iterations)
+                            for row in fluxes])
+    x = numpy.linspace(-1., 1., len(fluxes))
+    y = numpy.array(fluxes, dtype=float)
+    for i in range(iterations):
+        continuum = numpy.polynomial.polynomial.polyval(
+            x, numpy.polynomial.polynomial.polyfit(x, y, degree))
+        y = numpy.maximum(fluxes, continuum)
+    return fluxes - continuum
+
+
+def baseline_als(fluxes, smoothness=1e7, asymmetry=0.01, iterations=10):
+    """Correct the baseline of the spectrum whose ordinate values are in
+    ``fluxes`` with an asymmetric least squares fit of the continuum (Eilers
+    and Boelens, 2005).
+
+    The continuum is a smooth curve, with ``smoothness`` penalizing its
+    second derivative. Points below the curve (the absorption lines) are
+    given a weight ``asymmetry`` in the fit, those above a weight 1 -
+    ``asymmetry``.
+
+    """
+    import scipy.sparse
+    import scipy.sparse.linalg
+    if fluxes.ndim > 1:
+        return numpy.array([baseline_als(row, smoothness, asymmetry,
+                                         iterations) for row in fluxes])
+    n = len(fluxes)
+    diff2 = scipy.sparse.diags([1., -2., 1.], [0, 1, 2], shape=(n - 2, n))
+    penalty = smoothness * diff2.T.dot(diff2)
+    weights = numpy.ones(n)
+    for i in range(iterations):
+        w = scipy.sparse.diags(weights)
+        continuum = scipy.sparse.linalg.spsolve(
+            (w + penalty).tocsc(), weights * fluxes)
+        weights = numpy.where(fluxes < continuum, asymmetry, 1 - asymmetry)
+    return fluxes - continuum
+
+
+BASELINES = {
+    'tophat': baseline_tophat,
+    'fast-tophat': baseline_fast_tophat,
+    'poly': baseline_poly,
+    'als': baseline_als,
+}
+
+
+def baseline(fluxes, fraction_pts=0.2, method='fast-tophat'):
+    """Correct the baseline of the spectrum whose ordinate values are in
+    ``fluxes``, i.e., transform its continuum into a straight line at zero,
+    with the given method (see BASELINES).
+
+    The structuring element of the top hat methods covers ``fraction_pts`` of
+    the spectrum. The other methods do not use it.
+
+    """
+    func = BASELINES[method]
+    if func in (baseline_tophat, baseline_fast_tophat):
+        return func(fluxes, fraction_pts)
+    return func(fluxes)
+
+
+@functools.lru_cache()
+def smoothing_kernel(window_width=7, passes=3):
+    """Return the kernel equivalent to ``passes`` successive moving averages
+    over ``window_width`` points."""
+    box = numpy.ones(window_width) / window_width
+    kernel = numpy.ones(1)
+    for i in range(passes):
+        kernel = numpy.convolve(kernel, box)
+    kernel.flags.writeable = False
+    return kernel
+
+
+def _convolve_valid(y, kernel):
+    """Convolve ``y``, or all its rows at once, with the symmetric
+    ``kernel``, keeping only the points where the kernel fits entirely in the
+    data."""
+    if y.ndim == 1:
+        return numpy.convolve(y, kernel, 'valid')
+    # The windows are views of y, the data is not copied.
+    windows = numpy.lib.stride_tricks.sliding_window_view(y, len(kernel),
+                                                          axis=-1)
+    return windows.dot(kernel)
+
+
+def _smooth_passes(fluxes, window_width, passes):
+    """Apply ``passes`` moving averages to fluxes, reflecting the data at the
+    edges before each pass."""
+    smoothed = fluxes
     weights = numpy.ones(window_width) / window_width
     half_width = window_width // 2
+    pad = [(0, 0)] * (fluxes.ndim - 1) + [(half_width, half_width)]
     for i in range(passes):
-        smoothed = numpy.concatenate((smoothed[half_width:0:-1], smoothed,
-                smoothed[-2:-half_width - 2: -1]))
-        smoothed = numpy.convolve(smoothed, weights, 'valid')
+        smoothed = _convolve_valid(numpy.pad(smoothed, pad, mode='reflect'),
+                                   weights)
     return smoothed
 
 
-def find_helium(fname, plot=False, plot_all=False, verbose=False,
-        threshold=1.0):
-    """Open the spectrum file ``fname`` and determine whether there are traces
-    of helium."""
-    f = open(fname)
-    nb_wavs = int(f.readline().split()[0])
-    wavs = read_list(f, nb_wavs)
-    fluxes = read_list(f, nb_wavs)
-    f.close()
+@functools.lru_cache()
+def _edge_operator(window_width, passes):
+    """Return the matrix that maps the first 2 * reach points of a spectrum
+    to the first reach points of its smoothed version, where reach is the
+    half width of the smoothing kernel."""
+    reach = passes * (window_width // 2)
+    operator = _smooth_passes(numpy.eye(2 * reach), window_width,
+                              passes)[:, :reach]
+    operator.flags.writeable = False
+    return operator
+
+
+def smooth_spectrum(fluxes, window_width=7, passes=3):
+    """Produce a smoothed version of the spectra using a sliding window
+    approach.
+
+    The passes of moving average are combined in a single kernel (see
+    smoothing_kernel). The points near the edges, where each pass reflects
+    the data, go through a precomputed linear operator instead. ``fluxes``
+    may also be a 2-D array with one spectrum per row.
+
+    """
+    fluxes = numpy.asarray(fluxes, dtype=float)
+    kernel = smoothing_kernel(window_width, passes)
+    reach = len(kernel) // 2
+    nb_pts = fluxes.shape[-1]
+    # The edges of a segment of 2 * reach points are not affected by the
+    # reflection at its other end.
+    edge = 2 * reach
+    if nb_pts < 2 * edge:
+        return _smooth_passes(fluxes, window_width, passes)
+    operator = _edge_operator(window_width, passes)
+    smoothed = numpy.empty_like(fluxes)
+    smoothed[..., reach:nb_pts - reach] = _convolve_valid(fluxes, kernel)
+    smoothed[..., :reach] = fluxes[..., :edge].dot(operator)
+    smoothed[..., :nb_pts - reach - 1:-1] = \
+        fluxes[..., :nb_pts - edge - 1:-1].dot(operator)
+    return smoothed
+
+
+def match_lines(fname, wavs, line_indices_sn, noise, catalog):
+    """Match the lines found in the spectrum ``fname`` (pairs of line center
+    index in ``wavs`` and signal to noise ratio) against ``catalog`` and
+    return the HeliumResult. ``noise`` is the noise along the spectrum."""
+    lines = [(float(wavs[line_index]), float(sn))
+             for line_index, sn in line_indices_sn]
+    matched, nearest = catalog.match([line for line, sn in lines])
+    found = [lines[i] + (float(catalog.wavelengths[j]), catalog.species[j])
+             for i, j in zip(matched, nearest)]
+    types = catalog.classify([(catalog.species[j], catalog.weights[j])
+                              for j in nearest])
+    return HeliumResult(fname, lines, found, types, float(numpy.median(noise)),
+                        None)
+
+
+def screen_spectrum(name, wavs, fluxes, threshold=1.0, catalog=None,
+        baseline_method='fast-tophat', plot_all=False):
+    """Determine whether there are traces of helium in the spectrum with
+    wavelengths ``wavs`` and fluxes ``fluxes``, named ``name`` in the result.
+
+    The continuum is removed with ``baseline_method`` (see BASELINES). The
+    lines found in the spectrum are matched against ``catalog``, a
+    LineCatalog which defaults to the helium lines. Return a HeliumResult.
+    There are traces of helium when at least two lines match a helium line.
+
+    """
+    if catalog is None:
+        catalog = LineCatalog(HELIUM_CATALOG)
 
     # Smooth the spectrum and correct its baseline, i.e., transform the
     # continuum into a straight line.
-    smoothed = smooth_spectrum(fluxes)
-    corrected = baseline(smoothed)
+    with instrument.timer('smooth'):
+        smoothed = smooth_spectrum(fluxes)
+    with instrument.timer('baseline'):
+        corrected = baseline(smoothed, method=baseline_method)
     #plot_spectrum(wavs, fluxes)
     #plt.plot(wavs, smoothed)
     #plot_spectrum(wavs, corrected)
     #plt.show()
 
-    line_indices_sn = find_lines(fluxes, smoothed, corrected, wavs=wavs,
-            plot=plot_all, threshold=threshold)
-
-    found = []
-    for line_index, sn in line_indices_sn:
-        for heline in HELIUM_LINES:
-            # Tolerate a 5 angstrom difference.
-            if abs(wavs[line_index] - heline) < 5.:
-                found.append((wavs[line_index], sn))
-    if len(found) >= 2:
-        print(fname)
+    with instrument.timer('noise'):
+        noise = estimate_noise(fluxes, smoothed)
+    with instrument.timer('detect'):
+        line_indices_sn = find_lines(fluxes, smoothed, corrected, wavs=wavs,
+                plot=plot_all, threshold=threshold, noise=noise)
+
+    with instrument.timer('match'):
+        return match_lines(name, wavs, line_indices_sn, noise[1], catalog)
+
+
+def find_helium(fname, plot=False, plot_all=False, verbose=False,
+        threshold=1.0, catalog=None, baseline_method='fast-tophat'):
+    """Open the spectrum file ``fname`` and determine whether there are traces
+    of helium (see screen_spectrum). With ``plot``, the helium lines of the
+    candidates are shown with heplot.
+
+    ``verbose`` is kept for compatibility with older callers: nothing is
+    printed anymore, the lines are always in the result.
+    """
+    with instrument.timer('load'):
+        wavs, fluxes = load_spectrum(fname)
+    result = screen_spectrum(fname, wavs, fluxes, threshold, catalog,
+                             baseline_method, plot_all)
+    if result.is_candidate and plot:
+        import heplot
+        heplot.plot_candidate(wavs, fluxes, result.matches)
+    return result
+
+
+def find_helium_batch(fnames, threshold=1.0, catalog=None,
+        baseline_method='fast-tophat'):
+    """Determine whether there are traces of helium in each of the spectrum
+    files in fnames, like find_helium.
+
+    The spectra are grouped by number of points. The spectra of each group
+    are smoothed, corrected and searched for lines all at once, as a 2-D
+    array, which gives the same results as find_helium on each file: only the
+    matching of the lines uses the wavelengths, and it is done for each
+    spectrum on its own grid. Spectra of a plate with the same number of
+    points thus go in the same group even when they start at other
+    wavelengths. Return the list
+    of HeliumResult, in the order of fnames. Files that cannot be read get a
+    result with an error message.
+
+    """
+    if catalog is None:
+        catalog = LineCatalog(HELIUM_CATALOG)
+    results = {}
+    # Spectra with the same number of points, by number of points: (names,
+    # wavelengths, fluxes).
+    groups = collections.OrderedDict()
+    with instrument.timer('load'):
+        for fname in fnames:
+            try:
+                wavs, fluxes = load_spectrum(fname)
+            except Exception as e:
+                results[fname] = HeliumResult(fname, [], [], [],
+                                              float('nan'), str(e) or repr(e))
+                continue
+            group = groups.setdefault(len(fluxes), ([], [], []))
+            group[0].append(fname)
+            group[1].append(wavs)
+            group[2].append(fluxes)
+    for names, grids, rows in groups.values():
+        fluxes = numpy.array(rows)
+        with instrument.timer('smooth'):
+            smoothed = smooth_spectrum(fluxes)
+        with instrument.timer('baseline'):
+            corrected = baseline(smoothed, method=baseline_method)
+        with instrument.timer('noise'):
+            noise = estimate_noise(fluxes, smoothed)
+        with instrument.timer('detect'):
+            lines = find_lines_batch(fluxes, smoothed, corrected,
+                                     threshold=threshold, noise=noise)
+        with instrument.timer('match'):
+            for fname, wavs, line_indices_sn, row_noise in zip(
+                    names, grids, lines, noise[1]):
+                results[fname] = match_lines(fname, wavs, line_indices_sn,
+                                             row_noise, catalog)
+    return [results[fname] for fname in fnames]
+
+
+def iter_filenames(paths):
+    """Yield the names of the spectrum files in paths.
+
+    Each path is either a spectrum file, a spectrum store (see specstore)
+    whose spectra are named STORE/NAME, a directory whose files (except
+    hidden ones) are all spectra, or '-' to read file names from the standard
+    input, one per line.
+
+    """
+    for path in paths:
+        if path == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.strip()
+        elif specstore.is_store(path):
+            with specstore.SpectrumStore(path) as store:
+                names = list(store)
+            for name in names:
+                yield os.path.join(path, name)
+        elif os.path.isdir(path):
+            for fname in sorted(os.listdir(path)):
+                if not fname.startswith('.'):
+                    yield os.path.join(path, fname)
+        else:
+            yield path
+
+
+def _screen(fname, **options):
+    """Run find_helium on fname with options and return the HeliumResult, with
+    the error message if it fails."""
+    try:
+        return find_helium(fname, **options)
+    except Exception as e:
+        return HeliumResult(fname, [], [], [], float('nan'),
+                            str(e) or repr(e))
+
+
+def _screen_stack(fnames, **options):
+    """Run find_helium_batch on the list fnames with options and return the
+    list of HeliumResult, with the error message if it fails."""
+    try:
+        return find_helium_batch(fnames, **options)
+    except Exception as e:
+        return [HeliumResult(fname, [], [], [], float('nan'),
+                             str(e) or repr(e)) for fname in fnames]
+
+
+def _stacks(fnames, size):
+    """Yield lists of ``size`` file names from fnames."""
+    fnames = iter(fnames)
+    while True:
+        stack = list(itertools.islice(fnames, size))
+        if not stack:
+            return
+        yield stack
+
+
+def screen_files(fnames, jobs=1, chunksize=8, stack=0, **options):
+    """Search for helium in all the spectrum files in fnames.
+
+    The options (threshold, catalog, baseline_method) are passed to
+    find_helium. Yield a HeliumResult for each file, in the order of fnames.
+    Errors are reported in the results rather than raised. With ``stack``
+    greater than 1, the spectra are processed ``stack`` at a time with
+    find_helium_batch. With ``jobs`` greater than 1, the files (or stacks)
+    are sent ``chunksize`` (or one) at a time to a pool of ``jobs``
+    processes. ``fnames`` may be any iterable; it is consumed as the work
+    progresses.
+
+    """
+    if stack > 1:
+        screen = functools.partial(_screen_stack, **options)
+        tasks = _stacks(fnames, stack)
+        chunksize = 1
+    else:
+        screen = functools.partial(_screen, **options)
+        tasks = fnames
+    pool = None
+    if jobs <= 1:
+        results = map(screen, tasks)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(screen, tasks, chunksize)
+    try:
+        for result in results:
+            if stack > 1:
+                for stacked in result:
+                    yield stacked
+            else:
+                yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def fingerprint(fname):
+    """Return the pair (size, stamp) identifying the current version of the
+    spectrum file fname: its size in bytes and modification time in
+    nanoseconds. For a spectrum STORE/NAME of a spectrum store, whose records
+    are never rewritten, the stamp is the offset of its record."""
+    store, name = _store_member(fname)
+    if store is not None:
+        entry = store.index[name]
+        return 2 * entry['length'] * specstore.DTYPE.itemsize, entry['offset']
+    stat = os.stat(fname)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def content_hash(fname):
+    """Return the SHA-1 hash of the content of the spectrum file fname (or of
+    the record of a stored spectrum)."""
+    sha1 = hashlib.sha1()
+    store, name = _store_member(fname)
+    if store is not None:
+        for array in store.get(name):
+            sha1.update(array.tobytes())
+        return sha1.hexdigest()
+    with open(fname, 'rb') as f:
+        for block in iter(functools.partial(f.read, 2**16), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class ResultCache(object):
+    """Persistent store of the results of hefind, for incremental screening.
+
+    The results are stored in the SQLite database ``fname``, keyed by the path
+    of the spectrum file and the detector parameters (see params). A result
+    is reused while the size and modification time of the file are unchanged
+    or, when they changed, if the file still has the same content hash. A
+    file copied or renamed gets the result of the spectrum with the same
+    content. Results with errors are not stored.
+
+    Changes are written to the database by commit() and close().
+
+    """
+
+    def __init__(self, fname):
+        folder = os.path.dirname(fname)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(fname)
+        self._db.execute('CREATE TABLE IF NOT EXISTS results (path TEXT, '
+                         'params TEXT, size INTEGER, stamp INTEGER, '
+                         'sha1 TEXT, data TEXT, PRIMARY KEY (path, params))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_sha1 ON '
+                         'results (sha1, params)')
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def params(threshold=1.0, catalog=None, baseline_method='fast-tophat',
+               stack=0):
+        """Return the key of the detector parameters, as used by
+        screen_files. Results obtained with other parameters, including
+        another catalog or tolerance, are not reused."""
+        if catalog is None:
+            catalog = LineCatalog(HELIUM_CATALOG)
+        key = {'version': __version__, 'threshold': threshold,
+               'baseline': baseline_method, 'stacked': stack > 1,
+               'catalog': [catalog.wavelengths.tolist(), catalog.species,
+                           catalog.weights.tolist(), catalog.tolerance]}
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode(
+            'utf-8')).hexdigest()
+
+    @staticmethod
+    def _encode(result):
+        return json.dumps([result.lines, result.matches, result.types,
+                           result.noise])
+
+    @staticmethod
+    def _decode(fname, data):
+        lines, matches, types, noise = json.loads(data)
+        return HeliumResult(fname, [tuple(line) for line in lines],
+                            [tuple(match) for match in matches], types, noise,
+                            None)
+
+    def get(self, fname, params):
+        """Look up the spectrum file fname screened with params.
+
+        Return the pair (result, version) where result is the stored
+        HeliumResult, or None if the file is new or changed, and version the
+        triple (size, stamp, hash) to pass to put() with its new result.
+        version is None if the file cannot be read.
+
+        """
+        try:
+            size, stamp = fingerprint(fname)
+        except (IOError, OSError):
+            self.misses += 1
+            return None, None
+        entry = self._db.execute('SELECT size, stamp, sha1, data FROM '
+                                 'results WHERE path = ? AND params = ?',
+                                 (fname, params)).fetchone()
+        if entry is not None and tuple(entry[:2]) == (size, stamp):
+            self.hits += 1
+            return self._decode(fname, entry[3]), tuple(entry[:3])
+        try:
+            sha1 = content_hash(fname)
+        except (IOError, OSError):
+            self.misses += 1
+            return None, None
+        if entry is None or entry[2] != sha1:
+            entry = self._db.execute('SELECT size, stamp, sha1, data FROM '
+                                     'results WHERE sha1 = ? AND params = ? '
+                                     'LIMIT 1', (sha1, params)).fetchone()
+        if entry is None:
+            self.misses += 1
+            return None, (size, stamp, sha1)
+        # Same content under another name or modification time.
+        self.put(fname, params, (size, stamp, sha1),
+                 self._decode(fname, entry[3]))
+        self.hits += 1
+        return self._decode(fname, entry[3]), (size, stamp, sha1)
+
+    def put(self, fname, params, version, result):
+        """Store the result of the spectrum file fname, at version (see get),
+        screened with params."""
+        self._db.execute('INSERT OR REPLACE INTO results VALUES '
+                         '(?, ?, ?, ?, ?, ?)',
+                         (fname, params) + tuple(version) +
+                         (self._encode(result),))
+
+    def commit(self):
+        """Write the changes to the database."""
+        self._db.commit()
+
+    def close(self):
+        """Write the changes and close the database."""
+        self._db.commit()
+        self._db.close()
+
+
+def screen_incremental(fnames, cache, jobs=1, chunksize=8, stack=0,
+                       **options):
+    """Search for helium in all the spectrum files in fnames, like
+    screen_files, but only in the files that are new or changed since their
+    result was stored in ``cache``, a ResultCache.
+
+    The results of the unchanged files are taken from the cache and those of
+    the other files are stored in it. Yield a HeliumResult for each file, in
+    the order of fnames, which are all looked up before screening starts.
+
+    """
+    params = cache.params(stack=stack, **options)
+    entries = []
+    with instrument.timer('cache'):
+        for fname in fnames:
+            result, version = cache.get(fname, params)
+            entries.append((fname, result, version))
+            instrument.count('cache hits' if result is not None
+                             else 'cache misses')
+    fresh = screen_files([fname for fname, result, version in entries
+                          if result is None], jobs, chunksize, stack,
+                         **options)
+    try:
+        for fname, result, version in entries:
+            if result is None:
+                result = next(fresh)
+                if result.error is None and version is not None:
+                    cache.put(fname, params, version, result)
+            yield result
+    finally:
+        fresh.close()
+        cache.commit()
+
+
+def write_text(results, out, verbose=False):
+    """Write the name of the candidate files to out, followed by their helium
+    lines if verbose."""
+    for result in results:
+        if not result.is_candidate:
+            continue
+        out.write(result.fname + '\n')
         if verbose:
-            for line, sn in found:
-                print('   line {:.1f} angstrom; S/N {:.2f}'.format(line, sn))
-        if plot:
-            plot_spectrum(wavs, fluxes)
-            for line, sn in found:
-                plt.axvline(x=line, color='r', alpha=0.2, linewidth=2)
-            plt.show()
+            for line, sn, catline, species in result.matches:
+                out.write('   line {:.1f} angstrom; S/N {:.2f}\n'.format(
+                    line, sn))
+        out.flush()
+
+
+CSV_COLUMNS = ['fname', 'candidate', 'types', 'nb_lines', 'matches',
+               'max_sn', 'noise', 'error']
+
+
+def write_csv(results, out, verbose=False):
+    """Write one CSV record per result to out. Matched lines are written as
+    species:wavelength:S/N triples separated by semicolons."""
+    writer = csv.writer(out)
+    writer.writerow(CSV_COLUMNS)
+    for result in results:
+        writer.writerow([
+            result.fname, int(result.is_candidate), ' '.join(result.types),
+            len(result.lines),
+            ';'.join('{}:{:.1f}:{:.2f}'.format(species, line, sn)
+                     for line, sn, catline, species in result.matches),
+            '{:.2f}'.format(result.max_sn), '{:.5g}'.format(result.noise),
+            result.error or ''])
+        out.flush()
+
+
+def write_jsonl(results, out, verbose=False):
+    """Write one JSON object per line for each result to out. All lines are
+    included if verbose."""
+    for result in results:
+        record = {'fname': result.fname, 'candidate': result.is_candidate,
+                  'types': result.types,
+                  'matches': [{'wavelength': line, 'sn': sn,
+                               'catalog_line': catline, 'species': species}
+                              for line, sn, catline, species
+                              in result.matches],
+                  'max_sn': result.max_sn, 'noise': result.noise,
+                  'error': result.error}
+        if verbose:
+            record['lines'] = [{'wavelength': line, 'sn': sn}
+                               for line, sn in result.lines]
+        if record['noise'] != record['noise']:
+            # NaN is not valid JSON.
+            record['noise'] = None
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+
+
+WRITERS = {'text': write_text, 'csv': write_csv, 'jsonl': write_jsonl}
 
 
 def run(argv=sys.argv[1:]):
@@ -227,17 +1070,120 @@ def run(argv=sys.argv[1:]):
     clparser.add_argument('-p', '--plot', action='store_true',
             help='draw plot showing helium lines in spectrum')
     clparser.add_argument('filenames', nargs='+',
-            help='spectrum files to process')
+            help='spectrum files to process. A directory stands for all the ' +
+            'files it contains, a spectrum store written by sloany --store ' +
+            'for all its spectra and - for file names read from the ' +
+            'standard input')
+    clparser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+            help='number of processes screening spectra simultaneously; ' +
+            'ignored when plotting (default: 1)')
+    clparser.add_argument('-s', '--stack', type=int, default=0, metavar='N',
+            help='screen N spectra at a time, those with the same number ' +
+            'of points as a single array (default: one at a time)')
+    clparser.add_argument('-c', '--catalog', default='helium',
+            help='catalog of lines to look for: helium (the default), wd ' +
+            '(helium, hydrogen and calcium lines to classify DA, DB and DZ ' +
+            'white dwarfs) or the name of a file with one line per row: ' +
+            'wavelength, species and optional weight')
+    clparser.add_argument('--tolerance', type=float, default=5.,
+            help='maximum difference in angstroms between a line and a ' +
+            'catalog line (default: 5)')
+    clparser.add_argument('-b', '--baseline', choices=sorted(BASELINES),
+            default='fast-tophat',
+            help='continuum removal method: white top hat with scipy ' +
+            '(tophat) or with running min/max (fast-tophat, the default), ' +
+            'iterative polynomial fit (poly) or asymmetric least squares ' +
+            '(als)')
+    clparser.add_argument('-f', '--format', choices=sorted(WRITERS),
+            default='text',
+            help='output format: names of candidate files (text, the ' +
+            'default) or one record per spectrum (csv, jsonl)')
+    clparser.add_argument('--cache', metavar='FILE',
+            help='keep the results in the database FILE and only screen ' +
+            'the spectra that are new or changed since the previous runs ' +
+            'with the same options; ignored when plotting')
+    clparser.add_argument('--summary', action='store_true',
+            help='print the number of spectra screened and candidates ' +
+            'found on the standard error')
     clparser.add_argument('--verbose', action='store_true',
-            help='verbose output (prints lines and signal to noise ratio)')
+            help='verbose output (prints lines and signal to noise ratio; ' +
+            'with jsonl, includes all the lines found)')
     clparser.add_argument('-t', '--threshold', nargs='?', type=float,
             const=1.0, default=1.0,
             help='a signal raises that many times above the background noise')
+    clparser.add_argument('--stats', action='store_true',
+            help='print the time spent in each stage (load, smooth, ' +
+            'baseline, ...) and counters on the standard error. With -j, ' +
+            'the stages run in the worker processes are not timed')
+    clparser.add_argument('--stats-json', metavar='FILE',
+            help='write the time spent in each stage and the counters to ' +
+            'FILE, in JSON')
+    clparser.add_argument('--profile', metavar='FILE',
+            help='run under cProfile and save the profile to FILE (e.g., ' +
+            'hefind.pstats), to be read with the pstats module')
     args = clparser.parse_args(argv)
+    instrument.call(_run, (args,), stats=args.stats,
+                    stats_json=args.stats_json, profile=args.profile)
+
+
+def _run(args):
+    """Run the command given by the parsed command line arguments args."""
+    catalog = load_catalog(args.catalog, args.tolerance)
+    fnames = iter_filenames(args.filenames)
+    cache = None
+    if args.plot or args.plot_all:
+        results = (find_helium(fname, plot=args.plot, plot_all=args.plot_all,
+                               threshold=args.threshold, catalog=catalog,
+                               baseline_method=args.baseline)
+                   for fname in fnames)
+    elif args.cache:
+        cache = ResultCache(args.cache)
+        results = screen_incremental(fnames, cache, jobs=args.jobs,
+                                     stack=args.stack,
+                                     threshold=args.threshold,
+                                     catalog=catalog,
+                                     baseline_method=args.baseline)
+    else:
+        results = screen_files(fnames, jobs=args.jobs, stack=args.stack,
+                               threshold=args.threshold, catalog=catalog,
+                               baseline_method=args.baseline)
+
+    counts = collections.Counter()
+
+    def counted(results):
+        for result in results:
+            counts['files'] += 1
+            instrument.count('spectra screened')
+            if result.error is not None:
+                counts['errors'] += 1
+                instrument.count('errors')
+                print('WARNING: could not process {} ({}).'.format(
+                      result.fname, result.error), file=sys.stderr)
+            elif result.is_candidate:
+                counts['candidates'] += 1
+                instrument.count('candidates')
+            yield result
 
-    for fname in args.filenames:
-        find_helium(fname, plot=args.plot, plot_all=args.plot_all,
-                verbose=args.verbose, threshold=args.threshold)
+    start = time.time()
+    try:
+        with instrument.timer('screen'):
+            WRITERS[args.format](counted(results), sys.stdout,
+                                 verbose=args.verbose)
+    finally:
+        if cache is not None:
+            results.close()
+            cache.close()
+    if args.summary:
+        elapsed = max(time.time() - start, 1e-6)
+        print('Screened {} spectra in {:.1f} s ({:.1f} spectra/s): {} '
+              'candidates, {} errors.'.format(counts['files'], elapsed,
+                                              counts['files'] / elapsed,
+                                              counts['candidates'],
+                                              counts['errors']),
+              file=sys.stderr)
+        if cache is not None:
+            print('{} results from the cache, {} spectra screened.'.format(
+                  cache.hits, cache.misses), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+======
+heplot
+======
+
+Plots of the spectra and of the lines found by hefind. This module is only
+imported by hefind when plotting is requested, so that screening spectra does
+not pay for importing matplotlib.
+
+Copyright (c) 2012, Loïc Séguin-C. <loicseguin@gmail.com>
+
+"""
+
+
+__author__ = "Loïc Séguin-C. <loicseguin@gmail.com>"
+__license__ = "BSD"
+__version__ = '0.1dev'
+
+
+import matplotlib.pyplot as plt
+import numpy
+
+import hefind
+
+
+def plot_spectrum(freqs, fluxes, min_lambda=3700, max_lambda=8000):
+    """Plot the flux as a function of frequency."""
+    plt.plot(freqs, fluxes)
+    plt.xlim((min_lambda, max_lambda))
+    plt.xlabel(r'$\lambda\, (\AA)$', size=16)
+    plt.ylabel(r'$Flux$', size=16)
+    #plt.axes().minorticks_on()
+
+
+def make_spectrum_figure(f):
+    """Create a figure showing spectrum contained in file f."""
+    freqs, fluxes = hefind.read_spectrum(f)
+    plot_spectrum(freqs, fluxes)
+    plt.show()
+
+
+def plot_lines(wavs, corrected, noise, below, line_indices):
+    """Show the corrected spectrum, the line complexes (the points where
+    ``below`` is true) and the lines found by hefind.find_lines."""
+    plt.plot(wavs, corrected, wavs, -noise)
+    edges = numpy.diff(below.astype(int), prepend=0, append=0)
+    for start, stop in zip(numpy.flatnonzero(edges == 1),
+                           numpy.flatnonzero(edges == -1)):
+        plt.axvspan(wavs[start], wavs[stop - 1], color='g', alpha=0.1)
+    for line, sn in line_indices:
+        plt.axvline(x=wavs[line], color='r', alpha=0.3, linewidth=2)
+    plt.show()
+
+
+def plot_candidate(wavs, fluxes, matches):
+    """Show the spectrum with the lines that match the catalog (the matches
+    of a hefind.HeliumResult)."""
+    plot_spectrum(wavs, fluxes)
+    for line, sn, catline, species in matches:
+        plt.axvline(x=line, color='r', alpha=0.2, linewidth=2)
+    plt.show()
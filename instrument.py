@@ -0,0 +1,193 @@
+#-*- coding: utf-8 -*-
+
+"""
+==========
+instrument
+==========
+
+Per-stage timers and counters for sloany and hefind.
+
+Instrumentation is off until enable() is called. Until then, timer() returns
+a shared context manager that does nothing and count() returns immediately,
+so that instrumented code runs at full speed. Timers and counters are only
+recorded in the process that enabled them; work done in pools of worker
+processes is accounted for by the timers around the pool.
+
+Copyright (c) 2012, Loïc Séguin-C. <loicseguin@gmail.com>
+
+"""
+
+from __future__ import print_function
+
+__author__ = "Loïc Séguin-C. <loicseguin@gmail.com>"
+__license__ = "BSD"
+__version__ = '0.1dev'
+
+
+import json
+import sys
+import threading
+import time
+
+
+class _Timer(object):
+    """Context manager adding the time spent in its block to a stage."""
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.name, time.time() - self.start)
+
+
+class _NullTimer(object):
+    """Context manager doing nothing, used when instrumentation is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Stats(object):
+    """Time spent in each stage, with its number of calls, and counters.
+
+    Safe to share between threads. Timers of the same stage running in
+    several threads at once add up.
+
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def timer(self, name):
+        """Return a context manager timing its block as stage name."""
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds, calls=1):
+        """Add seconds and calls to stage name."""
+        with self._lock:
+            total = self.timers.setdefault(name, [0., 0])
+            total[0] += seconds
+            total[1] += calls
+
+    def count(self, name, n=1):
+        """Add n to counter name."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        """Return the timers and counters as a dict that can be dumped as
+        JSON."""
+        with self._lock:
+            return {'wall_time': time.time() - self.start,
+                    'timers': dict((name, {'seconds': seconds,
+                                           'calls': calls})
+                                   for name, (seconds, calls)
+                                   in self.timers.items()),
+                    'counters': dict(self.counters)}
+
+    def summary(self):
+        """Return a table of the timers and counters. Counters are also
+        given per second of wall time."""
+        stats = self.as_dict()
+        wall_time = max(stats['wall_time'], 1e-6)
+        lines = ['{:<24} {:>10} {:>8}'.format('stage', 'time (s)', 'calls')]
+        for name, timer in sorted(stats['timers'].items(),
+                                  key=lambda item: -item[1]['seconds']):
+            lines.append('{:<24} {:>10.3f} {:>8}'.format(
+                name, timer['seconds'], timer['calls']))
+        if stats['counters']:
+            lines.append('{:<24} {:>10} {:>8}'.format('counter', 'total',
+                                                      'per s'))
+            for name, value in sorted(stats['counters'].items()):
+                lines.append('{:<24} {:>10} {:>8.1f}'.format(
+                    name, value, value / wall_time))
+        lines.append('Wall time: {:.3f} s'.format(wall_time))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, fname):
+        """Write the timers and counters to file fname, in JSON."""
+        with open(fname, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+_stats = None
+
+
+def enable():
+    """Turn instrumentation on and return the Stats being recorded."""
+    global _stats
+    _stats = Stats()
+    return _stats
+
+
+def disable():
+    """Turn instrumentation off."""
+    global _stats
+    _stats = None
+
+
+def get_stats():
+    """Return the Stats being recorded, or None if instrumentation is
+    off."""
+    return _stats
+
+
+def timer(name):
+    """Return a context manager timing its block as stage name."""
+    if _stats is None:
+        return _NULL_TIMER
+    return _stats.timer(name)
+
+
+def count(name, n=1):
+    """Add n to counter name."""
+    if _stats is not None:
+        _stats.count(name, n)
+
+
+def call(func, args=(), stats=False, stats_json=None, profile=None,
+         out=None):
+    """Call func(*args) with the instrumentation requested.
+
+    With ``stats``, the summary of the timers and counters is written to
+    ``out`` (the standard error by default) at the end. With ``stats_json``,
+    they are dumped as JSON to that file. With ``profile``, the call runs
+    under cProfile and the profile is saved to that file, to be read with
+    the pstats module. This is done even if func raises an exception or
+    exits.
+
+    """
+    if stats or stats_json:
+        enable()
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler is not None:
+            return profiler.runcall(func, *args)
+        return func(*args)
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(profile)
+        if _stats is not None:
+            if stats:
+                (out or sys.stderr).write(_stats.summary())
+            if stats_json:
+                _stats.dump(stats_json)
+            disable()
@@ -5,6 +5,7 @@ from distutils.core import setup
 setup(
     name = 'sloany',
     scripts = ['sloany.py'],
+    py_modules = ['hefind', 'heplot', 'instrument', 'specstore'],
     version = '0.1dev',
     description = 'A command line utility to query the SDSS database and retrieve spectra files.',
     author = 'Loïc Séguin-C.',
@@ -22,8 +22,25 @@ Options
 -------
     -q --query  : specify SQL query on the command line
     -f --fetch  : fetch the (lite) spectra for the objects
+    -j --jobs   : number of spectra to download or reduce simultaneously
+    --rate      : maximum number of requests per second to each mirror
+    -m --mirror : additional spectra mirror, see also ~/.sloanyrc
+    --retry-failed : only fetch the spectra whose download failed previously
+    --chunk-by  : execute large queries in pages of ranges of a column
+    --chunk-rows : approximate number of rows per page
+    --query-jobs : number of queries or pages sent simultaneously
+    --no-cache  : do not use the query results cache
+    --refresh   : execute the queries even if their results are cached
     -r --reduce : read the FITS file and produce a spectrum file readable by
                   fitchi2
+    --store     : with --reduce, add the spectra to a binary spectrum store
+    --export    : write the spectra of a binary spectrum store as text files
+    --pipeline  : fetch, reduce and screen each spectrum for helium as soon
+                  as it is downloaded
+    --screen-jobs : number of processes reducing and screening spectra
+    --stats     : print the time spent in each stage and counters
+    --stats-json : write the time spent in each stage and counters as JSON
+    --profile   : save a cProfile profile of the run
     -v	        : print version
     -h	        : print help message
 
@@ -66,23 +83,59 @@ __version__ = '0.1dev'
 
 
 import argparse
+import csv
+import hashlib
+import instrument
+import io
+import itertools
+import json
+import multiprocessing
+import numpy
 import os
 import pyfits
+import socket
+import specstore
+import sqlite3
 import sys
-import shutil
+import threading
+import time
+import zlib
 try:
     import urllib.request as request
     import urllib.parse as parse
+    import http.client as httplib
+    import queue
+    import configparser
 except ImportError:
     # Good old Python 2.
     import urllib as request
     import urllib as parse
+    import urlparse
+    parse.urlsplit = urlparse.urlsplit
+    parse.urljoin = urlparse.urljoin
+    import httplib
+    import Queue as queue
+    import ConfigParser as configparser
     input = raw_input
 
 
 skyserver_url='http://skyserver.sdss3.org/public/en/tools/search/x_sql.asp'
+# Maximum number of rows returned by the skyserver for a single query. Larger
+# results are silently truncated.
+SKYSERVER_MAX_ROWS = 500000
+
 spectra_url_westcoast = 'http://data.sdss3.org/sas/dr9/sdss/spectro/redux/%s/spectra/lite'
 spectra_url = 'http://mirror.sdss3.org/sas/dr9/sdss/spectro/redux/%s/spectra/lite'
+SPECTRA_MIRRORS = [spectra_url, spectra_url_westcoast]
+
+# Optional configuration file. Additional spectra mirrors are listed, one per
+# line, in the ``mirrors`` option of the [sloany] section. The query cache is
+# configured with the ``cache_dir``, ``cache_ttl`` (seconds), ``cache_size``
+# (bytes) and ``cache_max_rows`` options.
+CONFIG_FILE = os.path.expanduser('~/.sloanyrc')
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'sloany')
 
 
 # Target flags for white dwarfs
@@ -132,42 +185,945 @@ def subst_flags(stmt):
     return stmt
 
 
-def exec_query(query):
-    """Execute the SQL query and return a list of results.
+class Row(tuple):
+    """A row of query results.
+
+    Rows are tuples whose values can also be accessed by column name, like a
+    dictionary. The column names are shared by all the rows of a query, see
+    row_type.
+
+    """
+    __slots__ = ()
+    columns = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if not isinstance(key, (int, slice)):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key, default=None):
+        if key in self._index:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self.columns)
 
-    The results are returned as a list of dictionaries. Each result is a
-    dictionary keyed by column name in the query. The values are the results of
-    the query.
+    def items(self):
+        return list(zip(self.columns, self))
+
+
+def row_type(columns):
+    """Return a subclass of Row for the given column names."""
+    columns = tuple(columns)
+    index = dict((column, i) for i, column in enumerate(columns))
+    return type('Row', (Row,), {'__slots__': (), 'columns': columns,
+                                '_index': index})
+
+
+def open_query(query):
+    """Execute the SQL query and return a pair (columns, rows).
+
+    ``columns`` is the list of column names and ``rows`` an iterator over
+    tuples of values. The rows are parsed as the response of the skyserver is
+    received; they are not held in memory.
 
     """
     query = remove_comments(query)
     query = subst_flags(query)
     params = parse.urlencode({'cmd': query, 'format': 'csv'})
-    raw_results = request.urlopen(skyserver_url + '?%s' % params)
-    raw_results = raw_results.read().decode('utf-8')
-    raw_results = raw_results.strip().split('\n')
-
-    results = []
+    response = request.urlopen(skyserver_url + '?%s' % params)
+    if sys.version_info[0] >= 3:
+        response = io.TextIOWrapper(response, encoding='utf-8', newline='')
+    reader = csv.reader(response)
     # First line of results is a coma separated list of column names.
-    keys = raw_results[0].split(',')
+    columns = next(reader, [])
 
-    ## Other lines are csv for objects that match the query.
-    for line in raw_results[1:]:
-        results.append(dict(zip(keys, line.split(','))))
-    return results
+    def rows():
+        try:
+            for values in reader:
+                if values:
+                    yield tuple(values)
+        finally:
+            response.close()
+
+    return columns, rows()
+
+
+def iter_query(query, cache=None, refresh=False, compact=False):
+    """Execute the SQL query and yield the results one at a time.
+
+    Each result is a dict keyed by column name in the query or, with
+    ``compact``, a Row: a tuple that shares the column names with the other
+    rows and takes much less memory. If a QueryCache is given, the results
+    are read from it when available, unless ``refresh`` is True, and stored
+    in it otherwise.
+
+    """
+    def results():
+        with instrument.timer('query'):
+            columns, rows = open_query(query)
+        instrument.count('queries')
+        make_row = row_type(columns)
+        for values in rows:
+            instrument.count('rows')
+            yield make_row(values)
+
+    return _rows(_cached(cache, normalize_query(query), refresh, results),
+                 compact)
+
+
+def _rows(rows, compact):
+    """Return the Row iterator rows, converted to dicts unless compact."""
+    if compact:
+        return rows
+    return (dict(zip(row.columns, row)) for row in rows)
+
+
+def exec_query(query, compact=False):
+    """Execute the SQL query and return a list of results.
+
+    Each result is a dict (or a Row with ``compact``) keyed by column name in
+    the query. The values are the results of the query. Use iter_query to
+    avoid holding all the results in memory.
+
+    """
+    return list(iter_query(query, compact=compact))
+
+
+def imap_threads(func, items, jobs=4):
+    """Apply func to each item using ``jobs`` threads and yield the results in
+    the order of items.
+
+    Exceptions raised by func are raised again when the corresponding result
+    is reached.
+
+    """
+    items = list(items)
+    tasks = queue.Queue()
+    for i, item in enumerate(items):
+        tasks.put((i, item))
+    done = {}
+    cond = threading.Condition()
+
+    def worker():
+        while True:
+            try:
+                i, item = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = (True, func(item))
+            except Exception as e:
+                result = (False, e)
+            with cond:
+                done[i] = result
+                cond.notify()
+
+    threads = [threading.Thread(target=worker)
+               for i in range(max(1, min(jobs, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for i in range(len(items)):
+        with cond:
+            while i not in done:
+                cond.wait()
+            success, result = done.pop(i)
+        if not success:
+            raise result
+        yield result
+
+
+def _query_range(query, column, lo, hi, last, max_rows):
+    """Return the rows of query whose column value is in [lo, hi), or
+    [lo, hi] if last is True. The range is split in halves as long as the
+    skyserver returns max_rows rows, i.e., truncates the results."""
+    page = ('SELECT q.* FROM ({}) AS q WHERE q.{} >= {!r} AND q.{} {} {!r}'
+            .format(query, column, lo, column, '<=' if last else '<', hi))
+    columns, rows = open_query(page)
+    rows = list(rows)
+    if len(rows) < max_rows:
+        return columns, rows
+    if isinstance(lo, float):
+        mid = (lo + hi) / 2.
+    else:
+        mid = (lo + hi) // 2
+    if mid <= lo or mid >= hi:
+        print('WARNING: more than {} rows with {} = {}, results are '
+              'truncated.'.format(max_rows, column, lo), file=sys.stderr)
+        return columns, rows
+    columns, rows = _query_range(query, column, lo, mid, False, max_rows)
+    rows += _query_range(query, column, mid, hi, last, max_rows)[1]
+    return columns, rows
+
+
+def iter_chunked_query(query, column, chunk_rows=50000, jobs=4,
+                       max_rows=SKYSERVER_MAX_ROWS, cache=None,
+                       refresh=False, compact=False):
+    """Execute a large SQL query in pages and yield the results one at a time.
+
+    The query is split on ranges of values of ``column``, which must be a
+    numeric column selected by the query (e.g., plate or specobjid), so that
+    each page has about ``chunk_rows`` rows. A page for which the skyserver
+    returns ``max_rows`` rows is split again. At most ``jobs`` pages are
+    queried at the same time and the results are yielded in order of the
+    ranges, without duplicates. Since the query is used as a subquery, it
+    must not contain an ORDER BY clause unless it also uses TOP. See
+    iter_query for the use of ``cache``, ``refresh`` and ``compact``.
+
+    """
+    query = normalize_query(query).rstrip(';')
+    key = 'chunk by {}: {}'.format(column, query)
+    return _rows(_cached(cache, key, refresh, lambda: _iter_chunked_query(
+        query, column, chunk_rows, jobs, max_rows)), compact)
+
+
+def _iter_chunked_query(query, column, chunk_rows, jobs, max_rows):
+    columns, rows = open_query(
+        'SELECT MIN(q.{0}), MAX(q.{0}), COUNT(*) FROM ({1}) AS q'.format(
+            column, query))
+    bounds = next(rows, None)
+    if bounds is None or not int(bounds[2]):
+        return
+    try:
+        lo, hi = int(bounds[0]), int(bounds[1])
+    except ValueError:
+        lo, hi = float(bounds[0]), float(bounds[1])
+    nb_chunks = max(1, -(-int(bounds[2]) // chunk_rows))
+    if isinstance(lo, float):
+        edges = [lo + (hi - lo) * i / nb_chunks for i in range(nb_chunks)]
+    else:
+        edges = sorted(set(lo + (hi - lo) * i // nb_chunks
+                           for i in range(nb_chunks)))
+    ranges = [(start, stop, False) for start, stop in zip(edges, edges[1:])]
+    ranges.append((edges[-1], hi, True))
+
+    def query_range(bounds):
+        return _query_range(query, column, bounds[0], bounds[1], bounds[2],
+                            max_rows)
+
+    make_row = None
+    seen = set()
+    for columns, rows in imap_threads(query_range, ranges, jobs):
+        if make_row is None:
+            make_row = row_type(columns)
+        for values in rows:
+            if values not in seen:
+                seen.add(values)
+                yield make_row(values)
+
+
+def exec_queries(queries, jobs=4, cache=None, refresh=False, chunk_by=None,
+                 chunk_rows=50000):
+    """Execute the SQL queries and yield the list of results of each, in the
+    order of queries. The results are compact Rows (see iter_query).
+
+    At most ``jobs`` queries are sent to the skyserver at the same time. With
+    ``chunk_by``, each query is executed in pages (see iter_chunked_query)
+    and the ``jobs`` are shared between the queries and their pages. See
+    iter_query for the use of ``cache`` and ``refresh``.
+
+    """
+    queries = list(queries)
+    if not queries:
+        return iter([])
+    nb_parallel = max(1, min(jobs, len(queries)))
+    page_jobs = max(1, jobs // nb_parallel)
+
+    def execute(query):
+        if chunk_by:
+            return list(iter_chunked_query(query, chunk_by, chunk_rows,
+                                           jobs=page_jobs, cache=cache,
+                                           refresh=refresh, compact=True))
+        return list(iter_query(query, cache=cache, refresh=refresh,
+                               compact=True))
+
+    return imap_threads(execute, queries, nb_parallel)
+
+
+def merge_results(result_lists):
+    """Return the rows of all the lists of results, in order, without the
+    rows for the same spectrum (see spec_key) as an earlier row. Rows that do
+    not identify a spectrum are all kept."""
+    merged = []
+    seen = set()
+    for results in result_lists:
+        for obj in results:
+            try:
+                key = spec_key(obj)
+            except (KeyError, ValueError):
+                merged.append(obj)
+                continue
+            if key not in seen:
+                seen.add(key)
+                merged.append(obj)
+    return merged
+
+
+def normalize_query(query):
+    """Return the query with comments removed, flags substituted and
+    whitespace collapsed."""
+    return ' '.join(subst_flags(remove_comments(query)).split())
+
+
+class QueryCache(object):
+    """Persistent cache of query results.
+
+    The results are stored in an SQLite database in folder ``path``, keyed by
+    the normalized text of the query. Entries older than ``ttl`` seconds are
+    discarded and the least recently used entries are evicted when the cache
+    grows over ``max_size`` bytes. Results of more than ``max_rows`` rows are
+    not cached, so that they do not have to be held in memory.
+
+    """
+
+    def __init__(self, path=CACHE_DIR, ttl=86400., max_size=100 * 2**20,
+                 max_rows=100000):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(path, 'queries.sqlite'),
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT '
+                         'PRIMARY KEY, created REAL, accessed REAL, '
+                         'size INTEGER, data BLOB)')
+        self._db.commit()
+
+    @staticmethod
+    def _hash(query):
+        return hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+    def get(self, query):
+        """Return the pair (columns, rows) stored for query, or None."""
+        key = self._hash(query)
+        now = time.time()
+        with self._lock:
+            entry = self._db.execute('SELECT created, data FROM results '
+                                     'WHERE key = ?', (key,)).fetchone()
+            if entry is None:
+                return None
+            if now - entry[0] > self.ttl:
+                self._db.execute('DELETE FROM results WHERE key = ?', (key,))
+                self._db.commit()
+                return None
+            self._db.execute('UPDATE results SET accessed = ? WHERE key = ?',
+                             (now, key))
+            self._db.commit()
+        columns, rows = json.loads(zlib.decompress(entry[1]).decode('utf-8'))
+        return columns, [tuple(values) for values in rows]
+
+    def put(self, query, columns, rows):
+        """Store the results of query and evict old entries."""
+        data = zlib.compress(json.dumps([columns, rows]).encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO results VALUES '
+                             '(?, ?, ?, ?, ?)',
+                             (self._hash(query), now, now, len(data),
+                              sqlite3.Binary(data)))
+            total = self._db.execute(
+                'SELECT SUM(size) FROM results').fetchone()[0]
+            entries = self._db.execute(
+                'SELECT key, size FROM results ORDER BY accessed').fetchall()
+            for key, size in entries[:-1]:
+                if total <= self.max_size:
+                    break
+                self._db.execute('DELETE FROM results WHERE key = ?', (key,))
+                total -= size
+            self._db.commit()
+
+
+def _cached(cache, key, refresh, results):
+    """Yield the rows stored in cache for key, or those produced by calling
+    results(), storing them in the cache unless there are more than
+    cache.max_rows."""
+    if cache is not None and not refresh:
+        entry = cache.get(key)
+        if entry is not None:
+            instrument.count('cache hits')
+            make_row = row_type(entry[0])
+            for values in entry[1]:
+                yield make_row(values)
+            return
+    columns = ()
+    rows = [] if cache is not None else None
+    for row in results():
+        if rows is not None:
+            columns = row.columns
+            rows.append(tuple(row))
+            if len(rows) > cache.max_rows:
+                # Too large to cache, stop holding the rows in memory.
+                rows = None
+        yield row
+    if rows is not None:
+        cache.put(key, list(columns), rows)
+
+
+def read_config(fname=CONFIG_FILE):
+    """Read the configuration file and return a dictionary of options."""
+    config = configparser.RawConfigParser()
+    config.read(fname)
+    if not config.has_section('sloany'):
+        return {}
+    return dict(config.items('sloany'))
+
+
+class HTTPError(IOError):
+    """The server answered with an error status."""
+
+    def __init__(self, status, msg):
+        IOError.__init__(self, msg)
+        self.status = status
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP connections to the spectra mirrors.
+
+    Idle connections are kept per host and reused by subsequent requests, so
+    that fetching many spectra from the same mirror does not pay for a new TCP
+    handshake every time. Requests to a given host are spaced so that at most
+    ``rate`` requests per second are started (no limit when ``rate`` is 0).
+
+    The pool is safe to share between threads; each connection is used by a
+    single thread at a time.
 
+    """
+    max_redirects = 5
+
+    def __init__(self, rate=0., timeout=60):
+        self.rate = rate
+        self.timeout = timeout
+        self._idle = {}
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, scheme, host):
+        """Return a connection to host, waiting for the rate limit."""
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            conn = idle.pop() if idle else None
+            now = time.time()
+            slot = max(now, self._next_slot.get(host, now))
+            if self.rate:
+                self._next_slot[host] = slot + 1. / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+        if conn is None:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(host, timeout=self.timeout)
+        return conn
+
+    def _release(self, scheme, host, conn):
+        with self._lock:
+            self._idle.setdefault((scheme, host), []).append(conn)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
+
+    def fetch(self, url, fileobj, headers=None, on_response=None):
+        """Download url and write the body of the response to fileobj.
+
+        Return a pair (response, nb_bytes). Redirections are followed. If
+        given, ``on_response`` is called with the final response before its
+        body is written. Raise IOError if the server answers with an error
+        status or if the connection fails.
+
+        """
+        for i in range(self.max_redirects + 1):
+            response, nb_bytes = self._fetch_once(url, fileobj, headers,
+                                                  on_response)
+            if response.status in (301, 302, 303, 307, 308):
+                url = parse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status >= 400:
+                raise HTTPError(response.status,
+                                'HTTP error {} {} for {}'.format(
+                                    response.status, response.reason, url))
+            return response, nb_bytes
+        raise IOError('Too many redirections for {}'.format(url))
+
+    def head(self, url):
+        """Send a HEAD request for url and return the response.
+
+        Raise IOError if the connection fails.
+
+        """
+        return self._fetch_once(url, None, None, None, method='HEAD')[0]
+
+    def _fetch_once(self, url, fileobj, headers, on_response, method='GET'):
+        parts = parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        # An idle connection may have been closed by the server in the
+        # meantime, in which case the request is tried again on a fresh
+        # connection. Failures on a fresh connection are not retried.
+        for attempt in range(2):
+            conn = self._acquire(parts.scheme, parts.netloc)
+            reused = conn.sock is not None
+            try:
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if attempt or not reused:
+                    raise IOError('Could not fetch {}: {}'.format(url, e))
+        nb_bytes = 0
+        try:
+            if method == 'HEAD':
+                pass
+            elif response.status < 300:
+                if on_response is not None:
+                    on_response(response)
+                while True:
+                    chunk = response.read(64 * 1024)
+                    if not chunk:
+                        break
+                    fileobj.write(chunk)
+                    nb_bytes += len(chunk)
+            else:
+                response.read()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            raise IOError('Could not fetch {}: {}'.format(url, e))
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(parts.scheme, parts.netloc, conn)
+        return response, nb_bytes
+
+
+class Manifest(object):
+    """Record of the spectra downloaded into a folder.
+
+    The manifest is kept in a file named MANIFEST in the folder. Each entry is
+    keyed by file name and records the url, size, ETag, Last-Modified date,
+    MD5 checksum and status ('ok', 'partial' or 'failed') of the download.
+    Updates are appended to the file as they happen so that nothing is lost
+    when a run is interrupted; the file is rewritten compactly on close.
+
+    """
+    filename = 'MANIFEST'
+
+    def __init__(self, dest='.'):
+        self.path = os.path.join(dest, self.filename)
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            for line in open(self.path):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line of an interrupted run.
+                    continue
+                self.entries.setdefault(entry.pop('name'), {}).update(entry)
+        self._file = open(self.path, 'a')
+
+    def get(self, name):
+        """Return the entry for file name, or an empty dict."""
+        return self.entries.get(name, {})
+
+    def update(self, name, **fields):
+        """Update the entry for file name with fields and record it."""
+        with self._lock:
+            entry = self.entries.setdefault(name, {})
+            entry.update(fields)
+            record = dict(entry, name=name)
+            self._file.write(json.dumps(record, sort_keys=True) + '\n')
+            self._file.flush()
+
+    def is_complete(self, name, destfile):
+        """Return True if destfile was completely downloaded."""
+        entry = self.get(name)
+        return (entry.get('status') == 'ok' and os.path.exists(destfile) and
+                os.path.getsize(destfile) == entry.get('size'))
+
+    def failed(self):
+        """Return the names of the files whose download failed."""
+        return [name for name, entry in self.entries.items()
+                if entry.get('status') == 'failed']
+
+    def close(self):
+        """Rewrite the manifest with one line per file."""
+        with self._lock:
+            self._file.close()
+            tmp = self.path + '.tmp'
+            f = open(tmp, 'w')
+            for name in sorted(self.entries):
+                record = dict(self.entries[name], name=name)
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.close()
+            replace(tmp, self.path)
 
-def fetch_spectra(spec_triples, dest='.'):
+
+# os.replace is not available in Python 2 where os.rename is atomic on POSIX.
+replace = getattr(os, 'replace', os.rename)
+
+
+class _HashingWriter(object):
+    """File wrapper computing the MD5 checksum of everything written."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        self.fileobj.write(data)
+
+
+def download_file(pool, url, destfile, manifest=None):
+    """Download url to destfile and return the number of bytes transferred.
+
+    The data is written to destfile.part which is atomically renamed to
+    destfile once complete. When a manifest is given, the download is
+    recorded in it and a partial file left by a previous attempt is resumed
+    with an HTTP Range request, provided the server still serves the same
+    version of the file (If-Range). A partial file that already has the size
+    of the file is renamed without downloading anything.
+
+    """
+    name = os.path.basename(destfile)
+    part = destfile + '.part'
+    entry = manifest.get(name) if manifest is not None else {}
+    validator = entry.get('etag') or entry.get('last_modified')
+    offset = 0
+    if validator and os.path.exists(part):
+        offset = os.path.getsize(part)
+        if entry.get('size') is not None and offset > entry['size']:
+            # Not the file the manifest knows about, start over.
+            offset = 0
+    complete = bool(offset) and offset == entry.get('size')
+    headers = {}
+    if offset:
+        headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+
+    f = open(part, 'r+b' if offset else 'wb')
+    writer = _HashingWriter(f)
+    # Checksum the part already on disk, then append to it.
+    while offset:
+        chunk = f.read(64 * 1024)
+        if not chunk:
+            break
+        writer.md5.update(chunk)
+    if complete:
+        # The previous run was interrupted after the last byte was written,
+        # before the partial file was renamed.
+        f.close()
+        replace(part, destfile)
+        manifest.update(name, url=url, status='ok', size=offset,
+                        md5=writer.md5.hexdigest())
+        return 0
+    expected = {}
+
+    def on_response(response):
+        if response.status != 206 and offset:
+            # The server sent the whole file, start over.
+            f.seek(0)
+            f.truncate()
+            writer.md5 = hashlib.md5()
+        length = response.getheader('Content-Length')
+        if length is not None:
+            expected['size'] = int(length)
+            if response.status == 206:
+                expected['size'] += f.tell()
+        if manifest is not None:
+            manifest.update(name, url=url, status='partial',
+                            size=expected.get('size'),
+                            etag=response.getheader('ETag'),
+                            last_modified=response.getheader('Last-Modified'))
+
+    try:
+        try:
+            response, nb_bytes = pool.fetch(url, writer, headers,
+                                            on_response=on_response)
+        finally:
+            size = f.tell()
+            f.close()
+        if size != expected.get('size', size):
+            raise IOError('Incomplete download of {} ({} of {} bytes)'.format(
+                url, size, expected['size']))
+    except IOError as e:
+        if offset and getattr(e, 'status', None) == 416:
+            # The server cannot resume the partial file (e.g., it is
+            # already complete but its size was not recorded), so the file
+            # is downloaded again from the start.
+            os.remove(part)
+            manifest.update(name, url=url, status='partial', etag=None,
+                            last_modified=None)
+            return download_file(pool, url, destfile, manifest)
+        if manifest is not None:
+            manifest.update(name, url=url, status='failed')
+            if not manifest.get(name).get('etag') and \
+                    not manifest.get(name).get('last_modified'):
+                # The partial file could not be resumed.
+                os.remove(part)
+        else:
+            os.remove(part)
+        raise
+    replace(part, destfile)
+    if manifest is not None:
+        manifest.update(name, url=url, status='ok', size=size,
+                        md5=writer.md5.hexdigest())
+    return nb_bytes
+
+
+def fetch_buffer(pool, url):
+    """Download url and return its content as bytes, without writing it to
+    disk."""
+    body = io.BytesIO()
+    expected = {}
+
+    def on_response(response):
+        length = response.getheader('Content-Length')
+        if length is not None:
+            expected['size'] = int(length)
+
+    pool.fetch(url, body, on_response=on_response)
+    data = body.getvalue()
+    instrument.count('bytes downloaded', len(data))
+    if len(data) != expected.get('size', len(data)):
+        raise IOError('Incomplete download of {} ({} of {} bytes)'.format(
+            url, len(data), expected['size']))
+    return data
+
+
+class MirrorPool(object):
+    """Spectra mirrors ranked by health and latency.
+
+    ``mirrors`` is a list of base URLs with a %s placeholder for run2d, like
+    ``spectra_url``. Each file is downloaded from the best ranked mirror; on
+    error the next mirror is tried. When all mirrors fail, the download is
+    attempted again after waiting ``backoff`` seconds, doubling the wait
+    after each round, for at most ``retries`` rounds. There must be at
+    least one mirror and one round.
+
+    """
+
+    def __init__(self, mirrors=SPECTRA_MIRRORS, retries=3, backoff=1.):
+        if not mirrors:
+            raise ValueError('at least one mirror is needed')
+        if retries < 1:
+            raise ValueError('retries must be at least 1, not {!r}'.format(
+                retries))
+        self.mirrors = list(mirrors)
+        self.retries = retries
+        self.backoff = backoff
+        self.latency = dict((mirror, 0.) for mirror in self.mirrors)
+        self.failures = dict((mirror, 0) for mirror in self.mirrors)
+        self._lock = threading.Lock()
+
+    def probe(self, pool, run2d, timeout=5.):
+        """Measure the latency of each mirror with a HEAD request on its base
+        URL for run2d.
+
+        All the mirrors are probed at the same time, over connections that
+        time out after ``timeout`` seconds rather than the timeout of
+        ``pool``, so that a mirror that does not answer delays the downloads
+        by seconds only. Mirrors that do not answer or answer with a server
+        error are counted as failed.
+
+        """
+        probe_pool = ConnectionPool(rate=pool.rate, timeout=timeout)
+
+        def latency(mirror):
+            start = time.time()
+            try:
+                response = probe_pool.head(mirror % run2d + '/')
+            except IOError:
+                return None
+            if response.status >= 500:
+                return None
+            return time.time() - start
+
+        try:
+            for mirror, seconds in zip(self.mirrors, imap_threads(
+                    latency, self.mirrors, len(self.mirrors))):
+                if seconds is None:
+                    self.report(mirror, False)
+                    self.latency[mirror] = float('inf')
+                else:
+                    self.latency[mirror] = seconds
+        finally:
+            probe_pool.close()
+
+    def report(self, mirror, success):
+        """Record the success or failure of a request on mirror."""
+        with self._lock:
+            if success:
+                self.failures[mirror] = 0
+            else:
+                self.failures[mirror] += 1
+
+    def ranked(self):
+        """Return the mirrors, the healthiest and fastest first."""
+        with self._lock:
+            return sorted(self.mirrors,
+                          key=lambda m: (self.failures[m], self.latency[m]))
+
+    def download(self, pool, run2d, path, destfile, manifest=None):
+        """Download the file at path relative to the base URL for run2d and
+        return the number of bytes transferred."""
+        return self._try_mirrors(run2d, path, lambda url: download_file(
+            pool, url, destfile, manifest))
+
+    def fetch(self, pool, run2d, path):
+        """Return the content of the file at path relative to the base URL
+        for run2d, without writing it to disk."""
+        return self._try_mirrors(run2d, path,
+                                 lambda url: fetch_buffer(pool, url))
+
+    def _try_mirrors(self, run2d, path, func):
+        """Return func(url) for the url of path on the best mirror that
+        works."""
+        for attempt in range(self.retries):
+            if attempt:
+                instrument.count('download retries')
+                time.sleep(self.backoff * 2**(attempt - 1))
+            missing = True
+            for mirror in self.ranked():
+                url = mirror % run2d + path
+                try:
+                    result = func(url)
+                except IOError as e:
+                    error = e
+                    if getattr(e, 'status', None) == 404:
+                        continue
+                    missing = False
+                    self.report(mirror, False)
+                    instrument.count('mirror failures')
+                    continue
+                self.report(mirror, True)
+                return result
+            if missing:
+                # No mirror has the file, trying again will not help.
+                break
+        raise error
+
+
+def download_files(downloads, jobs=4, rate=0., manifest=None, mirrors=None):
+    """Download spectra files concurrently.
+
+    ``downloads`` is a list of triples (run2d, path, destfile) where path is
+    relative to the mirrors base URL. Files are downloaded through
+    ``mirrors``, a MirrorPool which defaults to all the SPECTRA_MIRRORS. At
+    most ``jobs`` files are downloaded at the same time and connections to
+    each host are reused through a ConnectionPool limited to ``rate``
+    requests per second per host. Downloads are recorded in ``manifest`` if
+    one is given (see download_file). Print a throughput summary at the end
+    and return the list of downloads that failed.
+
+    """
+    pool = ConnectionPool(rate=rate)
+    if mirrors is None:
+        mirrors = MirrorPool()
+    if downloads and len(mirrors.mirrors) > 1:
+        mirrors.probe(pool, downloads[0][0])
+    tasks = queue.Queue()
+    for download in downloads:
+        tasks.put(download)
+    failed = []
+    totals = {'files': 0, 'bytes': 0}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                run2d, path, destfile = download = tasks.get_nowait()
+            except queue.Empty:
+                return
+            with lock:
+                print('Fetching {} --> {}'.format(path.split('/')[-1],
+                      destfile))
+            try:
+                with instrument.timer('download'):
+                    nb_bytes = mirrors.download(pool, run2d, path, destfile,
+                                                manifest)
+            except IOError as e:
+                instrument.count('failed downloads')
+                with lock:
+                    failed.append(download)
+                    print('WARNING: Could not retrieve {} ({}).'.format(
+                          os.path.basename(destfile), e), file=sys.stderr)
+                continue
+            with lock:
+                totals['files'] += 1
+                totals['bytes'] += nb_bytes
+            instrument.count('files downloaded')
+            instrument.count('bytes downloaded', nb_bytes)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker)
+               for i in range(max(1, min(jobs, len(downloads))))]
+    with instrument.timer('fetch'):
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+    pool.close()
+    elapsed = max(time.time() - start, 1e-6)
+    print('Fetched {} files ({:.1f} MB) in {:.1f} s: {:.1f} files/s, '
+          '{:.2f} MB/s. {} failed.'.format(
+              totals['files'], totals['bytes'] / 1e6, elapsed,
+              totals['files'] / elapsed, totals['bytes'] / 1e6 / elapsed,
+              len(failed)))
+    return failed
+
+
+def fetch_spectra(spec_triples, dest='.', jobs=4, rate=0., retry_failed=False,
+                  mirrors=SPECTRA_MIRRORS):
     """Fetch the spectra for all objects in spec_triples. Ask user confirmation
     first.
 
-    ``spec_triples`` is a list of triples (filename, plate, run2d).
+    ``spec_triples`` is a list of triples (filename, plate, run2d). Downloads
+    are recorded in the MANIFEST of the ``dest`` folder; a spectrum is
+    considered present only if the manifest says it was completely fetched.
+    If ``retry_failed`` is True, only the spectra whose download failed
+    previously are fetched. Spectra are fetched from the fastest of
+    ``mirrors`` that works.
 
     """
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    manifest = Manifest(dest)
+    try:
+        _fetch_spectra(spec_triples, manifest, dest, jobs, rate, retry_failed,
+                       mirrors)
+    finally:
+        manifest.close()
+
+
+def _fetch_spectra(spec_triples, manifest, dest, jobs, rate, retry_failed,
+                   mirrors):
     spec_files = list(spec_triples)
+    if retry_failed:
+        failed = set(manifest.failed())
+        spec_files = [specfile for specfile in spec_files
+                      if specfile[0] in failed]
+        if not spec_files:
+            print('No failed fetches to retry.')
+            return
     existing = []
     for specfile in spec_files:
-        if os.path.exists(os.path.join(dest, specfile[0])):
+        if manifest.is_complete(specfile[0],
+                                os.path.join(dest, specfile[0])):
             existing.append(specfile)
 
     # Ask user if he wants to fetch the spectra.
@@ -203,33 +1159,41 @@ def fetch_spectra(spec_triples, dest='.'):
 
     if answer.upper() not in ('Y', 'YES'):
         return
+    downloads = []
     for specfile in spec_files:
         if specfile[2] is None:
             print('WARNING: to fetch the spectra, query must select run2d.' +
                     ' Skipping file.', file=sys.stderr)
             continue
-        url = (spectra_url % specfile[2] +
-                '/{:04d}/'.format(int(specfile[1])) + specfile[0])
-        destfile = os.path.join(dest, specfile[0])
-        print('Fetching {} --> {}'.format(specfile[0], destfile))
-        try:
-            request.urlretrieve(url, specfile[0])
-            shutil.move(specfile[0], destfile)
-        except (ValueError, IOError):
-            f = open('Failed_Fetches', 'a')
-            f.write(specfile[0] + '\n')
-            f.close()
-            print('WARNING: Could not retrieve {} at {}.'.format(specfile[0],
-                  url), file=sys.stderr)
+        path = '/{:04d}/'.format(int(specfile[1])) + specfile[0]
+        downloads.append((specfile[2], path, os.path.join(dest, specfile[0])))
+    failed = download_files(downloads, jobs=jobs, rate=rate,
+                            manifest=manifest, mirrors=MirrorPool(mirrors))
+    if failed:
+        f = open('Failed_Fetches', 'a')
+        for run2d, path, destfile in failed:
+            f.write(os.path.basename(destfile) + '\n')
+        f.close()
+
+
+def reduce_spectra(fitsfiles, sdss_longs, dest='.', src='.', jobs=1,
+                   store=None):
+    """Produce a clean text file containing the spectra for each file in
+    files.
 
+    The FITS files are read from folder ``src``. With ``jobs`` greater than
+    1, the files are reduced in batches by a pool of ``jobs`` processes. If
+    ``store`` is a SpectrumStore opened for appending, the spectra are added
+    to it instead of being written to text files in ``dest``.
 
-def reduce_spectra(fitsfiles, sdss_longs, dest='.'):
-    """Produce a clean text file containing the spectra for each file in
-    files."""
+    """
     existing = []
-    fits_sdss = zip(fitsfiles, sdss_longs)
+    fits_sdss = list(zip(fitsfiles, sdss_longs))
     for fitsfile, sdss_long in fits_sdss:
-        if os.path.exists(os.path.join(dest, sdss_long)):
+        if store is not None:
+            if sdss_long in store:
+                existing.append((fitsfile, sdss_long))
+        elif os.path.exists(os.path.join(dest, sdss_long)):
             existing.append((fitsfile, sdss_long))
 
     if existing:
@@ -266,54 +1230,503 @@ def reduce_spectra(fitsfiles, sdss_longs, dest='.'):
 
     if answer.upper() not in ('Y', 'YES'):
         return
-    for fname, sdss_long in fits_sdss:
-        if not fname:
-            continue
-        out_fname = os.path.join(dest, sdss_long)
-        print('Reducing {} --> {}'.format(fname, out_fname))
-        f = pyfits.open(fname)
+    if store is None and not os.path.isdir(dest):
+        os.makedirs(dest)
+    if store is None:
+        tasks = [(os.path.join(src, fname), os.path.join(dest, sdss_long))
+                 for fname, sdss_long in fits_sdss if fname]
+    else:
+        # The workers send the spectra back, to be added to the store here.
+        tasks = [(os.path.join(src, fname), None)
+                 for fname, sdss_long in fits_sdss if fname]
+        store_names = dict((os.path.join(src, fname), sdss_long)
+                           for fname, sdss_long in fits_sdss if fname)
+    # Send the files to the workers in batches to limit the communication
+    # overhead, but keep the batches small enough to balance the load.
+    jobs = max(1, jobs)
+    batch_size = max(1, min(64, len(tasks) // (4 * jobs)))
+    batches = [tasks[i:i + batch_size]
+               for i in range(0, len(tasks), batch_size)]
+    start = time.time()
+    if jobs > 1 and len(batches) > 1:
+        pool = multiprocessing.Pool(jobs)
+        reduced = pool.imap_unordered(_reduce_batch, batches)
+    else:
+        pool = None
+        reduced = (_reduce_batch(batch) for batch in batches)
+    nb_failed = 0
+    with instrument.timer('reduce'):
+        try:
+            for batch in reduced:
+                for fname, out_fname, error, spectrum in batch:
+                    if error is None and spectrum is not None:
+                        out_fname = store_names[fname]
+                        wavs, fluxes = spectrum
+                        plate, mjd, fiber = parse_specfile_name(fname)
+                        try:
+                            store.add(out_fname, wavs, fluxes, plate, mjd,
+                                      fiber)
+                        except (IOError, ValueError) as e:
+                            error = str(e) or repr(e)
+                        else:
+                            out_fname = os.path.join(store.path, out_fname)
+                    if error is None:
+                        instrument.count('spectra reduced')
+                        print('Reducing {} --> {}'.format(fname, out_fname))
+                    else:
+                        nb_failed += 1
+                        instrument.count('failed reductions')
+                        print('WARNING: Could not reduce {} ({}).'.format(
+                              fname, error), file=sys.stderr)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    elapsed = max(time.time() - start, 1e-6)
+    print('Reduced {} spectra in {:.1f} s: {:.1f} spectra/s. {} failed.'
+          .format(len(tasks) - nb_failed, elapsed,
+                  (len(tasks) - nb_failed) / elapsed, nb_failed))
+
+
+def extract_spectrum(fname):
+    """Return the wavelengths and fluxes in the coadd HDU of FITS file
+    fname."""
+    f = pyfits.open(fname)
+    try:
         coadd = f[1]
-        fluxes = coadd.data.field('flux')
+        fluxes = coadd.data.field('flux').copy()
         wavs = 10**coadd.data.field('loglam')
-        assert len(fluxes) == len(wavs)
-        write_flux(out_fname, wavs, fluxes)
+    finally:
+        f.close()
+    if len(fluxes) != len(wavs):
+        raise ValueError('flux and loglam have different lengths')
+    return wavs, fluxes
+
+
+FITS_BLOCK = 2880
+# Binary table column types (TFORM) that can be read, as numpy types.
+FITS_TYPES = {'L': 'i1', 'B': 'u1', 'I': '>i2', 'J': '>i4', 'K': '>i8',
+              'E': '>f4', 'D': '>f8', 'C': '>c8', 'M': '>c16', 'A': 'S'}
+
+
+def _fits_value(text):
+    """Return the value in the value field of a FITS header card."""
+    text = text.strip()
+    if text.startswith("'"):
+        # Quotes inside strings are doubled.
+        value, quoted = '', text[1:]
+        while True:
+            end = quoted.find("'")
+            if end < 0:
+                return value + quoted
+            value += quoted[:end]
+            if quoted[end + 1:end + 2] != "'":
+                return value.rstrip()
+            value += "'"
+            quoted = quoted[end + 2:]
+    text = text.split('/')[0].strip()
+    if text in ('T', 'F'):
+        return text == 'T'
+    for convert in (int, lambda x: float(x.replace('D', 'E'))):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+def _fits_header(data, offset):
+    """Read the FITS header starting at offset in data. Return the pair
+    (header, offset of the data of the HDU)."""
+    header = {}
+    while True:
+        if offset + FITS_BLOCK > len(data):
+            raise ValueError('truncated FITS header')
+        block = bytes(data[offset:offset + FITS_BLOCK]).decode('ascii')
+        offset += FITS_BLOCK
+        for i in range(0, FITS_BLOCK, 80):
+            card = block[i:i + 80]
+            key = card[:8].strip()
+            if key == 'END':
+                return header, offset
+            if card[8:10] == '= ':
+                header[key] = _fits_value(card[10:])
+
+
+def _fits_data_size(header):
+    """Return the size in bytes of the data of an HDU, padding included."""
+    naxis = header.get('NAXIS', 0)
+    if not naxis:
+        return 0
+    nb_values = 1
+    for i in range(1, naxis + 1):
+        nb_values *= header['NAXIS{}'.format(i)]
+    size = (abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) *
+            (header.get('PCOUNT', 0) + nb_values))
+    return -(-size // FITS_BLOCK) * FITS_BLOCK
+
+
+def read_fits_columns(data, names, hdu=1):
+    """Return a dict with the columns ``names`` of the binary table in HDU
+    number ``hdu`` of the FITS file whose content is ``data``.
+
+    ``data`` may be any bytes-like object, e.g., the body of an HTTP
+    response. The columns are read only views of ``data`` (unless they are
+    scaled with TSCAL or TZERO). Column names are case insensitive.
+
+    """
+    offset = 0
+    for i in range(hdu + 1):
+        header, offset = _fits_header(data, offset)
+        if i < hdu:
+            offset += _fits_data_size(header)
+    if header.get('XTENSION') != 'BINTABLE':
+        raise ValueError('HDU {} is not a binary table'.format(hdu))
+    fields = []
+    columns = {}
+    position = 0
+    for i in range(1, header['TFIELDS'] + 1):
+        tform = header['TFORM{}'.format(i)].strip()
+        digits = len(tform) - len(tform.lstrip('0123456789'))
+        code = tform[digits:digits + 1]
+        if code not in FITS_TYPES:
+            raise ValueError('unsupported FITS column format ' + tform)
+        repeat = int(tform[:digits] or 1)
+        name = str(header.get('TTYPE{}'.format(i), 'col{}'.format(i)))
+        if code == 'A':
+            dtype = numpy.dtype((FITS_TYPES[code], repeat))
+        elif repeat == 1:
+            dtype = numpy.dtype(FITS_TYPES[code])
+        else:
+            dtype = numpy.dtype((FITS_TYPES[code], (repeat,)))
+        if repeat:
+            fields.append((name.lower(), dtype, position))
+            columns[name.lower()] = i
+        position += dtype.itemsize
+    if position != header['NAXIS1']:
+        raise ValueError('FITS table rows are {} bytes, expected {}'.format(
+            header['NAXIS1'], position))
+    rows = numpy.dtype({'names': [field[0] for field in fields],
+                        'formats': [field[1] for field in fields],
+                        'offsets': [field[2] for field in fields],
+                        'itemsize': position})
+    if offset + position * header['NAXIS2'] > len(data):
+        raise ValueError('truncated FITS table')
+    table = numpy.frombuffer(data, rows, count=header['NAXIS2'],
+                             offset=offset)
+    result = {}
+    for name in names:
+        i = columns[name.lower()]
+        column = table[name.lower()]
+        scale = header.get('TSCAL{}'.format(i), 1)
+        zero = header.get('TZERO{}'.format(i), 0)
+        if scale != 1 or zero != 0:
+            column = column * scale + zero
+        result[name] = column
+    return result
+
+
+def extract_spectrum_buffer(data):
+    """Return the wavelengths and fluxes in the coadd HDU of the FITS file
+    whose content is ``data``, without writing it to disk."""
+    columns = read_fits_columns(data, ['flux', 'loglam'])
+    fluxes = columns['flux'].astype(numpy.float32)
+    wavs = 10**columns['loglam'].astype(numpy.float32)
+    if len(fluxes) != len(wavs):
+        raise ValueError('flux and loglam have different lengths')
+    return wavs, fluxes
+
+
+def _reduce_batch(batch):
+    """Reduce the pairs (fitsfile, out_fname) in batch and return a list of
+    tuples (fitsfile, out_fname, error message or None, spectrum).
+
+    The spectrum is written to the text file out_fname, or returned as the
+    pair (wavs, fluxes) if out_fname is None.
+
+    """
+    results = []
+    for fname, out_fname in batch:
+        spectrum = None
+        try:
+            with instrument.timer('extract'):
+                wavs, fluxes = extract_spectrum(fname)
+            if out_fname is None:
+                spectrum = wavs, fluxes
+            else:
+                with instrument.timer('write'):
+                    write_flux(out_fname, wavs, fluxes)
+        except Exception as e:
+            results.append((fname, out_fname, str(e) or repr(e), None))
+        else:
+            results.append((fname, out_fname, None, spectrum))
+    return results
+
+
+def _screen_fits(task):
+    """Extract the spectrum of the FITS file in task and screen it for
+    helium.
+
+    ``task`` is a tuple (fitsfile, data, name, out_fname, keep, options).
+    The FITS file is parsed from ``data`` if it is not None, otherwise it is
+    read from disk. The spectrum is written to the text file out_fname unless
+    it is None and screened with hefind.screen_spectrum(name, ...,
+    **options). Return a tuple (fitsfile, name, HeliumResult or None, error
+    message or None, spectrum) where spectrum is the pair (wavs, fluxes) if
+    ``keep`` is True.
+
+    """
+    import hefind
+    fitsfile, data, name, out_fname, keep, options = task
+    try:
+        if data is None:
+            wavs, fluxes = extract_spectrum(fitsfile)
+        else:
+            wavs, fluxes = extract_spectrum_buffer(data)
+        if out_fname is not None:
+            write_flux(out_fname, wavs, fluxes)
+        result = hefind.screen_spectrum(name, wavs, fluxes, **options)
+    except Exception as e:
+        return fitsfile, name, None, str(e) or repr(e), None
+    return fitsfile, name, result, None, (wavs, fluxes) if keep else None
+
+
+def run_pipeline(objects, dest='.', jobs=4, screen_jobs=1, rate=0.,
+                 mirrors=SPECTRA_MIRRORS, reduce_dest=None, store=None,
+                 queue_size=64, **options):
+    """Fetch, reduce and screen for helium the spectra of objects, each
+    spectrum going through all the stages as soon as it is downloaded.
+
+    ``objects`` is a list of tuples (filename, plate, run2d, name) where name
+    is the SDSS name of the object. The FITS files are downloaded into
+    ``dest`` by ``jobs`` threads, as in download_files, unless the MANIFEST
+    says they are already there. If ``dest`` is None, the FITS files are
+    kept in memory only and parsed by extract_spectrum_buffer. They are then
+    extracted and screened with
+    hefind by ``screen_jobs`` processes, which receive at most
+    ``queue_size`` spectra ahead of the results. The options (threshold,
+    catalog, baseline_method) are passed to hefind.screen_spectrum. The
+    reduced spectra are also written to text files in ``reduce_dest`` or
+    added to ``store`` if given.
+
+    Candidates are printed as soon as they are found. Return the list of
+    HeliumResult.
+
+    """
+    manifest = None
+    if dest is not None:
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        manifest = Manifest(dest)
+    if reduce_dest is not None and not os.path.isdir(reduce_dest):
+        os.makedirs(reduce_dest)
+    pool = ConnectionPool(rate=rate)
+    mirrors = MirrorPool(mirrors)
+    tasks = queue.Queue()
+    for specfile, plate, run2d, name in objects:
+        if run2d is None and (manifest is None or not manifest.is_complete(
+                specfile, os.path.join(dest, specfile))):
+            print('WARNING: to fetch the spectra, query must select run2d.' +
+                  ' Skipping file.', file=sys.stderr)
+            continue
+        tasks.put((specfile, plate, run2d, name))
+    nb_tasks = tasks.qsize()
+    # The worker processes are forked before any thread is started, so that
+    # they cannot inherit a lock held by a thread (e.g., of the stats).
+    workers = None
+    if screen_jobs > 1:
+        workers = multiprocessing.Pool(screen_jobs)
+    run2ds = [run2d for specfile, plate, run2d, name in objects if run2d]
+    if run2ds and len(mirrors.mirrors) > 1:
+        mirrors.probe(pool, run2ds[0])
+    fetched = queue.Queue(queue_size)
+    slots = threading.Semaphore(queue_size)
+    # Set when the results are no longer read, e.g., after an error, so that
+    # the threads feeding the workers return instead of waiting forever.
+    stop = threading.Event()
+    lock = threading.Lock()
+    failed = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                fetched.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def downloader():
+        try:
+            download_tasks()
+        finally:
+            # ready() waits for one None per thread.
+            put(None)
+
+    def download_tasks():
+        while not stop.is_set():
+            try:
+                specfile, plate, run2d, name = tasks.get_nowait()
+            except queue.Empty:
+                break
+            data = None
+            try:
+                path = '/{:04d}/'.format(int(plate)) + specfile
+                with instrument.timer('download'):
+                    if manifest is None:
+                        fitsfile = specfile
+                        data = mirrors.fetch(pool, run2d, path)
+                    else:
+                        fitsfile = os.path.join(dest, specfile)
+                        if not manifest.is_complete(specfile, fitsfile):
+                            mirrors.download(pool, run2d, path, fitsfile,
+                                             manifest)
+            except Exception as e:
+                # Not only IOError: a bad row or a malformed response must
+                # not stop the thread.
+                instrument.count('failed downloads')
+                with lock:
+                    failed.append(specfile)
+                    print('WARNING: Could not retrieve {} ({}).'.format(
+                          specfile, str(e) or repr(e)), file=sys.stderr)
+                continue
+            instrument.count('files downloaded')
+            put((fitsfile, data, name))
+
+    threads = [threading.Thread(target=downloader)
+               for i in range(max(1, min(jobs, nb_tasks)))]
+
+    def ready():
+        remaining = len(threads)
+        while remaining:
+            try:
+                item = fetched.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return
+                continue
+            if item is None:
+                remaining -= 1
+                continue
+            # Do not get too far ahead of the results. Semaphores have no
+            # timeout in Python 2.
+            while not slots.acquire(False):
+                if stop.wait(0.01):
+                    return
+            fitsfile, data, name = item
+            out_fname = None
+            if reduce_dest is not None:
+                out_fname = os.path.join(reduce_dest, name)
+            yield fitsfile, data, name, out_fname, store is not None, options
+
+    start = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    if workers is not None:
+        screened = workers.imap_unordered(_screen_fits, ready())
+    else:
+        screened = (_screen_fits(task) for task in ready())
+    results = []
+    nb_failed = 0
+    with instrument.timer('pipeline'):
+        try:
+            for fitsfile, name, result, error, spectrum in screened:
+                slots.release()
+                if error is not None:
+                    nb_failed += 1
+                    instrument.count('failed reductions')
+                    print('WARNING: Could not screen {} ({}).'.format(
+                          fitsfile, error), file=sys.stderr)
+                    continue
+                if store is not None:
+                    plate, mjd, fiber = parse_specfile_name(fitsfile)
+                    store.add(name, spectrum[0], spectrum[1], plate, mjd,
+                              fiber)
+                results.append(result)
+                instrument.count('spectra screened')
+                if result.is_candidate:
+                    instrument.count('candidates')
+                    with lock:
+                        print('Candidate {} ({}): {}'.format(
+                              name, os.path.basename(fitsfile),
+                              ' '.join(result.types)))
+        finally:
+            stop.set()
+            if workers is not None:
+                workers.terminate()
+                workers.join()
+            pool.close()
+            if manifest is not None:
+                manifest.close()
+    elapsed = max(time.time() - start, 1e-6)
+    print('Screened {} spectra in {:.1f} s: {:.1f} spectra/s. {} candidates, '
+          '{} failed downloads, {} failed reductions.'.format(
+              len(results), elapsed, len(results) / elapsed,
+              sum(result.is_candidate for result in results), len(failed),
+              nb_failed))
+    return results
+
+
+def format_block(values, fmt, per_line):
+    """Format all values with fmt, per_line values per line, in a single
+    string. Each line is preceded by a newline."""
+    values = numpy.asarray(values, dtype=float).ravel().tolist()
+    nb_lines, remainder = divmod(len(values), per_line)
+    line_fmt = ('\n' + fmt * per_line) * nb_lines
+    if remainder:
+        line_fmt += '\n' + fmt * remainder
+    return line_fmt % tuple(values)
 
 
 def write_flux(fname, wavs, flux):
     """Write the flux to file named fname in a format that fitchi2 understands.
+
+    The wavelengths are written 10 per line and the fluxes 6 per line. The
+    whole file is formatted in memory and written at once.
     """
     f = open(fname, 'w')
-    f.write(str(len(wavs)))
-    for i, wav in enumerate(wavs):
-        if i % 10 == 0:
-            f.write('\n')
-        f.write('%10.2f' % wav)
-    for i, fluxi in enumerate(flux):
-        if i % 6 == 0:
-            f.write('\n')
-        f.write('%12.5e' % (fluxi))
-    f.write('\n')
+    f.write(str(len(wavs)) + format_block(wavs, '%10.2f', 10) +
+            format_block(flux, '%12.5e', 6) + '\n')
     f.close()
-    return
+
+
+def export_store(store, dest='.'):
+    """Write every spectrum of the SpectrumStore ``store`` to a text file
+    readable by fitchi2 in folder dest and return their number."""
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    for name in store:
+        wavs, fluxes = store.get(name)
+        write_flux(os.path.join(dest, name), wavs, fluxes)
+    return len(store)
 
 
 def print_results(results):
-    """Print the results of the query."""
-    if not results:
-        print('Query returned no results')
-        return
-    keys = results[0].keys()
-    for key in keys:
-        print('{:<11}'.format(key), end='')
-    print()
-    for key in keys:
-        print('{:<11}'.format(10*'='), end='')
-    print()
+    """Print the results of the query and return their number.
+
+    ``results`` can be any iterable of rows, e.g., the generator returned by
+    iter_query.
+
+    """
+    nb_results = 0
     for result in results:
+        if not nb_results:
+            keys = result.keys()
+            for key in keys:
+                print('{:<11}'.format(key), end='')
+            print()
+            for key in keys:
+                print('{:<11}'.format(10*'='), end='')
+            print()
         for key in keys:
             print('{:<11}'.format(result[key]), end='')
         print()
-    print('Query returned {} objects'.format(len(results)))
+        nb_results += 1
+    if not nb_results:
+        print('Query returned no results')
+        return 0
+    print('Query returned {} objects'.format(nb_results))
+    return nb_results
 
 
 def specfile_name(obj):
@@ -324,6 +1737,24 @@ def specfile_name(obj):
     return specfile
 
 
+def parse_specfile_name(fname):
+    """Return the triple (plate, mjd, fiberid) from the name of a spectrum
+    fits file (see specfile_name), or (None, None, None) if the name does not
+    follow the SDSS convention."""
+    parts = os.path.basename(fname).split('.')[0].split('-')
+    try:
+        plate, mjd, fiberid = [int(part) for part in parts[1:]]
+    except ValueError:
+        return None, None, None
+    return plate, mjd, fiberid
+
+
+def spec_key(obj):
+    """Return the triple (plate, mjd, fiberid) identifying the spectrum of
+    object."""
+    return int(obj['plate']), int(obj['mjd']), int(obj['fiberid'])
+
+
 def sdss_name(ra, dec):
     """Determine the SDSS official name from the right ascension and the
     declination in degrees."""
@@ -350,39 +1781,81 @@ def sdss_name(ra, dec):
     return name, short_name
 
 
-def get_ra_dec(fname):
-    """From the file name, extract the plate, MJD and fiber id and use these to
-    grab the right ascension and declination for the object."""
-    plate, mjd, fiberid = obj['plate'], obj['mjd'], obj['fiberid']
-    query = "select s.ra,s.dec from \
-             bestdr9..SpecObj as s where s.plate={} and s.mjd={} and \
-             s.fiberid={}".format(plate, mjd, fiberid)
-    results = exec_query(query)
-    return float(results[0]['ra']), float(results[0]['dec'])
+def get_ra_dec(obj, cache=None):
+    """From the plate, MJD and fiber id of the object, grab the right ascension
+    and declination for the object."""
+    return get_ra_dec_batch([obj], cache=cache)[spec_key(obj)]
+
+
+def get_ra_dec_batch(objs, batch_size=500, jobs=4, cache=None):
+    """Grab the right ascension and declination for all objects.
 
+    Return a dictionary mapping (plate, mjd, fiberid) to (ra, dec). The
+    objects are looked up ``batch_size`` at a time, with at most ``jobs``
+    queries sent to the skyserver at the same time.
 
-def write_metadata(results):
+    """
+    keys = sorted(set(spec_key(obj) for obj in objs))
+    queries = []
+    for i in range(0, len(keys), batch_size):
+        conditions = []
+        for (plate, mjd), group in itertools.groupby(
+                keys[i:i + batch_size], lambda key: key[:2]):
+            conditions.append('(s.plate={} and s.mjd={} and s.fiberid in '
+                              '({}))'.format(plate, mjd, ','.join(
+                                  str(key[2]) for key in group)))
+        queries.append('select s.plate,s.mjd,s.fiberid,s.ra,s.dec from '
+                       'bestdr9..SpecObj as s where ' +
+                       ' or '.join(conditions))
+
+    coords = {}
+    for results in imap_threads(
+            lambda query: list(iter_query(query, cache=cache, compact=True)),
+            queries, jobs):
+        for obj in results:
+            coords[spec_key(obj)] = float(obj['ra']), float(obj['dec'])
+    return coords
+
+
+def write_metadata(results, cache=None, fname='METADATA'):
     """If the results contain the right ascension and declination, create a
     metadata file containing the list of spectrum files along with the SDSS
-    name for the object."""
-    meta = open('METADATA', 'w')
+    name for the object.
+
+    Otherwise, the right ascension and declination of the objects are
+    grabbed with a few batched queries once all the results are read.
+
+    """
     metadata = []
+    missing = []
     for obj in results:
-        longname = ''
         if 'ra' in obj and 'dec' in obj:
             longname, shortname = sdss_name(obj['ra'], obj['dec'])
+            metadata.append((specfile_name(obj), longname, shortname))
         else:
-            longname, shortname = sdss_name(*get_ra_dec(obj))
-        if not longname:
-            continue
-        metainfo = (specfile_name(obj), longname, shortname)
-        metadata.append(metainfo)
-        meta.write('{}    {}    {}\n'.format(*metainfo))
-    print('Wrote METADATA file with {} objects.'.format(len(metadata)))
-    meta.close()
+            missing.append(obj)
+    if missing:
+        coords = get_ra_dec_batch(missing, cache=cache)
+        for obj in missing:
+            if spec_key(obj) not in coords:
+                print('WARNING: could not find the coordinates of ' +
+                      specfile_name(obj), file=sys.stderr)
+                continue
+            longname, shortname = sdss_name(*coords[spec_key(obj)])
+            metadata.append((specfile_name(obj), longname, shortname))
+    save_metadata(metadata, fname)
     return metadata
 
 
+def save_metadata(metadata, fname='METADATA'):
+    """Write the metadata, triples (spectrum file, SDSS name, short SDSS
+    name), to the metadata file fname."""
+    with open(fname, 'w') as meta:
+        for metainfo in metadata:
+            meta.write('{}    {}    {}\n'.format(*metainfo))
+    print('Wrote {} file with {} objects.'.format(fname, len(metadata)))
+
+
 def run(argv=sys.argv[1:]):
     """Parse the command line arguments and run the appropriate command."""
     clparser = argparse.ArgumentParser(
@@ -397,16 +1870,103 @@ def run(argv=sys.argv[1:]):
             metavar='FOLDER',
             help='fetch the spectrum file for each object. If optional ' +
             'FOLDER is provided, put the spectrum files in that folder.')
+    clparser.add_argument('-j', '--jobs', type=int, default=4, metavar='N',
+            help='number of spectra to download or reduce simultaneously ' +
+            '(default: 4)')
+    clparser.add_argument('--rate', type=float, default=5., metavar='R',
+            help='maximum number of requests per second to each spectra ' +
+            'mirror, 0 for no limit (default: 5)')
+    clparser.add_argument('-m', '--mirror', action='append', default=[],
+            metavar='URL',
+            help='additional mirror to fetch the spectra from. URL is the ' +
+            'base URL of the lite spectra with %%s in place of run2d, e.g., ' +
+            spectra_url.replace('%', '%%') + '. May be repeated.')
+    clparser.add_argument('--retry-failed', action='store_true',
+            help='only fetch the spectra whose download failed in a ' +
+            'previous run, according to the MANIFEST of the fetch folder')
+    clparser.add_argument('--chunk-by', metavar='COLUMN',
+            help='execute the queries in pages of ranges of values of ' +
+            'COLUMN, a numeric column selected by the query such as plate ' +
+            'or specobjid. Use for results larger than the skyserver limit')
+    clparser.add_argument('--chunk-rows', type=int, default=50000,
+            metavar='N', help='approximate number of rows per page with ' +
+            '--chunk-by (default: 50000)')
+    clparser.add_argument('--query-jobs', type=int, default=4, metavar='N',
+            help='number of queries sent to the skyserver simultaneously, ' +
+            'shared between the query files and, with --chunk-by, their ' +
+            'pages. The spectra selected by several queries are fetched ' +
+            'and reduced once (default: 4)')
+    clparser.add_argument('--no-cache', action='store_true',
+            help='do not use the query results cache')
+    clparser.add_argument('--refresh', action='store_true',
+            help='execute the queries even if their results are cached')
     clparser.add_argument('-r', '--reduce', nargs='?', const='.',
             help='create a file with the wavelengths and fluxes.' +
             ' If optional argument is provided, put the reduced spectrum ' +
             ' files in that folder.', metavar='FOLDER')
+    clparser.add_argument('--store', metavar='PATH',
+            help='with --reduce, add the spectra to the binary spectrum ' +
+            'store PATH (created if needed) instead of writing text files')
+    clparser.add_argument('--pipeline', action='store_true',
+            help='reduce each spectrum and screen it for helium as soon as ' +
+            'it is downloaded. The FITS files are kept in the --fetch ' +
+            'folder if given and only in memory otherwise. With --reduce, ' +
+            'the reduced spectra are also written or added to the --store')
+    clparser.add_argument('--screen-jobs', type=int,
+            default=multiprocessing.cpu_count(), metavar='N',
+            help='with --pipeline, number of processes reducing and ' +
+            'screening spectra (default: number of CPUs)')
+    clparser.add_argument('--export', metavar='STORE',
+            help='write the spectra of the spectrum store STORE as text ' +
+            'files readable by fitchi2, in the --reduce folder (default: ' +
+            'current folder)')
+    clparser.add_argument('--stats', action='store_true',
+            help='print the time spent in each stage and counters such as ' +
+            'the bytes downloaded on the standard error at the end')
+    clparser.add_argument('--stats-json', metavar='FILE',
+            help='write the time spent in each stage and the counters to ' +
+            'FILE, in JSON')
+    clparser.add_argument('--profile', metavar='FILE',
+            help='run under cProfile and save the profile to FILE (e.g., ' +
+            'sloany.pstats), to be read with the pstats module')
     args = clparser.parse_args(argv)
+    instrument.call(_run, (args,), stats=args.stats,
+                    stats_json=args.stats_json, profile=args.profile)
+
+
+def _run(args):
+    """Run the command given by the parsed command line arguments args."""
+    if args.export:
+        try:
+            store = specstore.SpectrumStore(args.export)
+        except IOError as e:
+            print('ERROR: {}.'.format(e), file=sys.stderr)
+            sys.exit(1)
+        with store:
+            nb_spectra = export_store(store, args.reduce or '.')
+        print('Exported {} spectra from {}.'.format(nb_spectra, args.export))
+        if not (args.query or args.filenames):
+            return
+    config = read_config()
+
+    # Mirrors given on the command line are preferred, then those from the
+    # configuration file.
+    mirrors = []
+    for mirror in (args.mirror + config.get('mirrors', '').split() +
+                   SPECTRA_MIRRORS):
+        if '%s' not in mirror:
+            print('ERROR: mirror URL {} does not contain %s.'.format(mirror),
+                  file=sys.stderr)
+            sys.exit(1)
+        if mirror not in mirrors:
+            mirrors.append(mirror)
 
-    # Make a list of all queries.
+    # Make a list of all queries, labelled for their metadata files.
     queries = []
+    labels = []
     if args.query:
         queries.append(args.query)
+        labels.append('query')
     for fname in args.filenames:
         try:
             queries.append(open(fname).read())
@@ -414,37 +1974,104 @@ def run(argv=sys.argv[1:]):
             print('WARNING: Could not open %s for reading.' % fname,
                   file=sys.stderr)
             sys.exit(1)
-
-    # Execute all queries.
-    for query in queries:
-        try:
-            results = exec_query(query)
-        except urllib.error.URLError as e:
-            print('ERROR: could not connect to URL', file=sys.stderr)
-            sys.exit(1)
-        if not results:
-            print('ERROR: query did not provide any results.', file=sys.stderr)
-            sys.exit(1)
-        print_results(results)
-        metadata = write_metadata(results)
-        if args.fetch:
-            spec_files = []
-            for obj in results:
-                try:
-                    specfile = specfile_name(obj)
-                    spec_files.append((specfile, obj['plate'],
-                                       obj.get('run2d')))
-                except KeyError:
-                    print(results)
+        label = os.path.splitext(os.path.basename(fname))[0]
+        if label in labels:
+            label += '.{}'.format(len(labels))
+        labels.append(label)
+
+    # Execute all queries at once, then fetch and reduce the spectra of all
+    # their results, each spectrum once.
+    cache = None
+    if not args.no_cache:
+        cache = QueryCache(config.get('cache_dir', CACHE_DIR),
+                           ttl=float(config.get('cache_ttl', 86400)),
+                           max_size=int(config.get('cache_size', 100 * 2**20)),
+                           max_rows=int(config.get('cache_max_rows', 100000)))
+    all_results = []
+    result_labels = []
+    try:
+        for label, results in zip(labels, exec_queries(
+                queries, jobs=args.query_jobs, cache=cache,
+                refresh=args.refresh, chunk_by=args.chunk_by,
+                chunk_rows=args.chunk_rows)):
+            if not results:
+                if len(queries) == 1:
+                    print('ERROR: query did not provide any results.',
+                          file=sys.stderr)
                     sys.exit(1)
-            fetch_spectra(spec_files, dest=args.fetch)
-        if args.reduce:
-            fitsfiles = []
-            sdss_longs = []
-            for fitsfile, sdss_long, sdss_short in metadata:
-                fitsfiles.append(fitsfile)
-                sdss_longs.append(sdss_long)
-            reduce_spectra(fitsfiles, sdss_longs, dest=args.reduce)
+                # The other queries may still find spectra.
+                print('WARNING: query {} did not provide any results. '
+                      'Skipping it.'.format(label), file=sys.stderr)
+                continue
+            print_results(results)
+            all_results.append(results)
+            result_labels.append(label)
+    except IOError:
+        print('ERROR: could not connect to URL', file=sys.stderr)
+        sys.exit(1)
+    if not queries:
+        return
+    if not all_results:
+        print('ERROR: no query provided any results.', file=sys.stderr)
+        sys.exit(1)
+    results = merge_results(all_results)
+    if len(queries) > 1:
+        print('{} queries returned {} distinct spectra.'.format(
+              len(all_results), len(results)))
+    with instrument.timer('metadata'):
+        metadata = write_metadata(results, cache=cache)
+    if len(queries) > 1:
+        by_specfile = dict((metainfo[0], metainfo) for metainfo in metadata)
+        for label, query_results in zip(result_labels, all_results):
+            specfiles = [specfile_name(obj) for obj in query_results]
+            save_metadata([by_specfile[specfile] for specfile in specfiles
+                           if specfile in by_specfile],
+                          'METADATA.' + label)
+    if args.pipeline:
+        locations = dict((specfile_name(obj), (obj['plate'],
+                                               obj.get('run2d')))
+                         for obj in results)
+        objects = [(specfile,) + locations[specfile] + (sdss_long,)
+                   for specfile, sdss_long, sdss_short in metadata]
+        store = None
+        if args.reduce and args.store:
+            store = specstore.SpectrumStore(args.store, 'a')
+        try:
+            run_pipeline(objects, dest=args.fetch, jobs=args.jobs,
+                         screen_jobs=args.screen_jobs, rate=args.rate,
+                         mirrors=mirrors, store=store,
+                         reduce_dest=None if store else args.reduce)
+        finally:
+            if store is not None:
+                store.close()
+        return
+    if args.fetch:
+        spec_files = []
+        for obj in results:
+            try:
+                specfile = specfile_name(obj)
+                spec_files.append((specfile, obj['plate'],
+                                   obj.get('run2d')))
+            except KeyError:
+                print(results)
+                sys.exit(1)
+        fetch_spectra(spec_files, dest=args.fetch, jobs=args.jobs,
+                      rate=args.rate, retry_failed=args.retry_failed,
+                      mirrors=mirrors)
+    if args.reduce:
+        fitsfiles = []
+        sdss_longs = []
+        for fitsfile, sdss_long, sdss_short in metadata:
+            fitsfiles.append(fitsfile)
+            sdss_longs.append(sdss_long)
+        if args.store:
+            with specstore.SpectrumStore(args.store, 'a') as store:
+                reduce_spectra(fitsfiles, sdss_longs,
+                               src=args.fetch or '.', jobs=args.jobs,
+                               store=store)
+        else:
+            reduce_spectra(fitsfiles, sdss_longs, dest=args.reduce,
+                           src=args.fetch or '.', jobs=args.jobs)
 
 
 if __name__=='__main__':
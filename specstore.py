@@ -0,0 +1,164 @@
+#-*- coding: utf-8 -*-
+
+"""
+=========
+specstore
+=========
+
+Compact binary storage for reduced spectra.
+
+A spectrum store is a folder holding two files:
+
+``spectra.f4``
+    the wavelengths and fluxes of all the spectra, as raw little endian 32
+    bit floats. Each spectrum is a record of its N wavelengths followed by
+    its N fluxes.
+``index.jsonl``
+    one JSON object per spectrum with its name (usually the SDSS name of the
+    object), plate, MJD, fiber, the offset of its record in ``spectra.f4``
+    (in values, not bytes) and its number of points N.
+
+Records are only ever appended. A spectrum added again under the same name
+supersedes the previous one. The data file is read through a memory map, so
+reading a spectrum does not copy it.
+
+Copyright (c) 2012, Loïc Séguin-C. <loicseguin@gmail.com>
+
+"""
+
+from __future__ import print_function
+
+__author__ = "Loïc Séguin-C. <loicseguin@gmail.com>"
+__license__ = "BSD"
+__version__ = '0.1dev'
+
+
+import json
+import numpy
+import os
+
+
+DATA_FILE = 'spectra.f4'
+INDEX_FILE = 'index.jsonl'
+DTYPE = numpy.dtype('<f4')
+
+
+def is_store(path):
+    """Return whether path is a spectrum store."""
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+class SpectrumStore(object):
+    """A collection of spectra stored in the folder ``path``.
+
+    With ``mode`` 'r', the store must exist and is read only. With mode 'a',
+    it is created if needed and spectra can be added to it.
+
+    """
+    def __init__(self, path, mode='r'):
+        if mode not in ('r', 'a'):
+            raise ValueError('mode must be r or a, not {!r}'.format(mode))
+        if mode == 'r' and not is_store(path):
+            raise IOError('{} is not a spectrum store'.format(path))
+        self.path = path
+        self.mode = mode
+        self.index = {}
+        self.keys = {}
+        self._data = None
+        self._data_file = None
+        self._index_file = None
+        if mode == 'a':
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._data_file = open(os.path.join(path, DATA_FILE), 'ab')
+            self._index_file = open(os.path.join(path, INDEX_FILE), 'a')
+        self._read_index()
+
+    def _read_index(self):
+        """Load the index of the store."""
+        fname = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(fname):
+            return
+        with open(fname) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partly written entry, e.g., after an interruption.
+                    continue
+                self._register(entry)
+
+    def _register(self, entry):
+        self.index[entry['name']] = entry
+        if entry.get('plate') is not None:
+            self.keys[entry['plate'], entry['mjd'], entry['fiber']] = \
+                entry['name']
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(sorted(self.index))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def find(self, plate, mjd, fiber):
+        """Return the name of the spectrum for plate, MJD and fiber, or None
+        if it is not in the store."""
+        return self.keys.get((int(plate), int(mjd), int(fiber)))
+
+    def add(self, name, wavs, fluxes, plate=None, mjd=None, fiber=None):
+        """Append the spectrum with wavelengths ``wavs`` and fluxes
+        ``fluxes`` to the store under ``name``."""
+        if self._data_file is None:
+            raise IOError('spectrum store {} is read only'.format(self.path))
+        wavs = numpy.asarray(wavs, dtype=DTYPE).ravel()
+        fluxes = numpy.asarray(fluxes, dtype=DTYPE).ravel()
+        if len(wavs) != len(fluxes):
+            raise ValueError('wavelengths and fluxes have different lengths')
+        offset = self._data_file.tell() // DTYPE.itemsize
+        self._data_file.write(wavs.tobytes())
+        self._data_file.write(fluxes.tobytes())
+        # The data must be on disk before the index refers to it.
+        self._data_file.flush()
+        entry = {'name': name, 'offset': offset, 'length': len(wavs),
+                 'plate': None if plate is None else int(plate),
+                 'mjd': None if mjd is None else int(mjd),
+                 'fiber': None if fiber is None else int(fiber)}
+        self._index_file.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._index_file.flush()
+        self._register(entry)
+
+    def _map(self, end):
+        """Return the memory map of the data file, mapping it again if it
+        does not extend to value ``end``."""
+        if self._data is None or len(self._data) < end:
+            self._data = numpy.memmap(os.path.join(self.path, DATA_FILE),
+                                      dtype=DTYPE, mode='r')
+        return self._data
+
+    def get(self, name):
+        """Return the arrays of wavelengths and fluxes of spectrum ``name``.
+
+        The arrays are read only views of the memory mapped data.
+        """
+        entry = self.index[name]
+        start = entry['offset']
+        length = entry['length']
+        record = self._map(start + 2 * length)[start:start + 2 * length]
+        return record[:length], record[length:]
+
+    def close(self):
+        """Close the files of the store."""
+        for f in (self._data_file, self._index_file):
+            if f is not None:
+                f.close()
+        self._data_file = self._index_file = None
+        self._data = None
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import synthetic
+
+
+@pytest.fixture
+def http_server():
+    """Return a function starting a local HTTP server (see
+    synthetic.LocalServer) with a request handler class and returning its
+    URL. The servers are shut down at the end of the test."""
+    servers = []
+
+    def start(handler):
+        local = synthetic.LocalServer(handler).__enter__()
+        servers.append(local)
+        return local.base_url
+
+    yield start
+    for local in servers:
+        local.__exit__(None, None, None)
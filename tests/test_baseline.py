@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""The fast top hat must correct the baseline like scipy's white top hat."""
+
+import os
+
+import numpy
+import pytest
+
+import hefind
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+REFERENCES = [os.path.join(DATA, 'lines-{}.txt'.format(i)) for i in range(6)]
+
+
+@pytest.fixture(scope='module')
+def smoothed():
+    return [hefind.smooth_spectrum(hefind.load_spectrum(fname)[1])
+            for fname in REFERENCES]
+
+
+@pytest.mark.parametrize('fraction_pts', [0.001, 0.05, 0.2, 0.3])
+def test_fast_tophat(smoothed, fraction_pts):
+    pytest.importorskip('scipy')
+    for fluxes in smoothed:
+        numpy.testing.assert_allclose(
+            hefind.baseline_fast_tophat(fluxes, fraction_pts),
+            hefind.baseline_tophat(fluxes, fraction_pts), rtol=0, atol=1e-12)
+
+
+def test_fast_tophat_rows(smoothed):
+    size = min(len(fluxes) for fluxes in smoothed)
+    fluxes = numpy.array([fluxes[:size] for fluxes in smoothed])
+    corrected = hefind.baseline_fast_tophat(fluxes)
+    for row, expected in zip(fluxes, corrected):
+        numpy.testing.assert_array_equal(
+            hefind.baseline_fast_tophat(row), expected)
+
+
+def test_fraction_pts(smoothed):
+    """The size of the structuring element is still the second argument."""
+    fluxes = smoothed[1]
+    numpy.testing.assert_array_equal(
+        hefind.baseline(fluxes, 0.3),
+        hefind.baseline_fast_tophat(fluxes, 0.3))
+    numpy.testing.assert_array_equal(
+        hefind.baseline(fluxes, fraction_pts=0.05, method='fast-tophat'),
+        hefind.baseline_fast_tophat(fluxes, 0.05))
+    assert not numpy.array_equal(hefind.baseline(fluxes, 0.3),
+                                 hefind.baseline(fluxes))
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Chunked queries against a local fake skyserver that truncates results to
+a maximum number of rows, like the real one."""
+
+import csv
+import http.server as server
+import io
+import re
+
+import pytest
+
+import sloany
+
+
+MAX_ROWS = 1000
+COLUMNS = ['plate', 'mjd', 'fiberid']
+# Table spectra has 20000 spectra on plates of 50 fibers and table crowded
+# 1500 spectra on the same plate.
+ROWS = [(3000 + i // 50, 55000, i % 50) for i in range(20000)]
+CROWDED_ROWS = [(9999, 56000, i) for i in range(1500)]
+
+BOUNDS = re.compile(r'^SELECT MIN\(q\.(\w+)\), MAX\(q\.\w+\), COUNT\(\*\) '
+                    r'FROM \((.*)\) AS q$')
+PAGE = re.compile(r'^SELECT q\.\* FROM \((.*)\) AS q WHERE q\.(\w+) >= '
+                  r'(\S+) AND q\.\w+ (<=?) (\S+)$')
+
+
+class SkyserverHandler(server.BaseHTTPRequestHandler):
+    """Answer the bounds and page queries of iter_chunked_query on the rows
+    of table ``crowded`` or ``spectra``, with at most MAX_ROWS rows."""
+    queries = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = sloany.parse.parse_qs(
+            sloany.parse.urlsplit(self.path).query)['cmd'][0].strip()
+        self.queries.append(query)
+        bounds = BOUNDS.match(query)
+        page = PAGE.match(query)
+        if bounds:
+            rows = self.table(bounds.group(2))
+            values = [row[COLUMNS.index(bounds.group(1))] for row in rows]
+            columns = ['Column1', 'Column2', 'Column3']
+            rows = [(min(values), max(values), len(values))]
+        elif page:
+            subquery, column, lo, op, hi = page.groups()
+            index = COLUMNS.index(column)
+            lo, hi = float(lo), float(hi)
+            columns = COLUMNS
+            rows = [row for row in self.table(subquery)
+                    if lo <= row[index] and (row[index] <= hi if op == '<='
+                                             else row[index] < hi)]
+        else:
+            columns = COLUMNS
+            rows = self.table(query)
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(rows[:MAX_ROWS])
+        body = out.getvalue().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def table(query):
+        return CROWDED_ROWS if 'crowded' in query else ROWS
+
+
+@pytest.fixture
+def skyserver(monkeypatch, http_server):
+    SkyserverHandler.queries = []
+    monkeypatch.setattr(sloany, 'skyserver_url',
+                        http_server(SkyserverHandler) + '/')
+    return SkyserverHandler
+
+
+def keys(rows):
+    return [(int(row['plate']), int(row['mjd']), int(row['fiberid']))
+            for row in rows]
+
+
+def test_plain_query_is_truncated(skyserver):
+    assert len(list(sloany.iter_query('select * from spectra'))) == MAX_ROWS
+
+
+def test_chunked_query_is_complete(skyserver):
+    rows = list(sloany.iter_chunked_query(
+        'select * from spectra', 'plate', chunk_rows=3000, jobs=4,
+        max_rows=MAX_ROWS))
+    assert sorted(keys(rows)) == ROWS
+    # Pages of 3000 rows are truncated and split until they fit.
+    assert len(skyserver.queries) > 20000 // 3000 + 1
+
+
+def test_chunked_query_warns_when_truncated(skyserver, capsys):
+    rows = list(sloany.iter_chunked_query(
+        'select * from crowded', 'plate', chunk_rows=3000,
+        max_rows=MAX_ROWS))
+    assert len(rows) == MAX_ROWS
+    assert len(set(keys(rows))) == MAX_ROWS
+    assert 'results are truncated' in capsys.readouterr().err
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Resuming downloads with download_file against a local stand-in for a
+spectra mirror."""
+
+import http.server as server
+import os
+
+import pytest
+
+import sloany
+
+
+CONTENT = bytes(bytearray(range(256))) * 40
+ETAG = '"abc123"'
+
+
+class RangeHandler(server.BaseHTTPRequestHandler):
+    """Serve CONTENT at every path, with an ETag and support for Range
+    requests. Ranges starting at or after the end of the file get a 416."""
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('Range'))
+        start = 0
+        status = 200
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range') == ETAG:
+            start = int(byte_range.split('=')[1].rstrip('-'))
+            status = 206
+        if start >= len(CONTENT):
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = CONTENT[start:]
+        self.send_response(status)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(CONTENT) - 1, len(CONTENT)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def mirror(http_server):
+    RangeHandler.requests = []
+    return http_server(RangeHandler) + '/spec.fits'
+
+
+def download(url, folder):
+    """Download url to spec.fits in folder with its manifest and return the
+    number of bytes transferred."""
+    manifest = sloany.Manifest(str(folder))
+    pool = sloany.ConnectionPool()
+    try:
+        return sloany.download_file(pool, url,
+                                    os.path.join(str(folder), 'spec.fits'),
+                                    manifest)
+    finally:
+        pool.close()
+        manifest.close()
+
+
+def check_complete(folder):
+    destfile = os.path.join(str(folder), 'spec.fits')
+    with open(destfile, 'rb') as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(destfile + '.part')
+    entry = sloany.Manifest(str(folder)).get('spec.fits')
+    assert entry['status'] == 'ok'
+    assert entry['size'] == len(CONTENT)
+
+
+def leave_part(folder, data, **entry):
+    """Simulate a run interrupted after data was written to the partial
+    file, with the manifest entry recorded at that point."""
+    with open(os.path.join(str(folder), 'spec.fits.part'), 'wb') as f:
+        f.write(data)
+    manifest = sloany.Manifest(str(folder))
+    manifest.update('spec.fits', status='partial', etag=ETAG, **entry)
+    manifest.close()
+
+
+def test_download(mirror, tmpdir):
+    assert download(mirror, tmpdir) == len(CONTENT)
+    check_complete(tmpdir)
+
+
+def test_resume_partial(mirror, tmpdir):
+    leave_part(tmpdir, CONTENT[:1000], size=len(CONTENT))
+    assert download(mirror, tmpdir) == len(CONTENT) - 1000
+    assert RangeHandler.requests == ['bytes=1000-']
+    check_complete(tmpdir)
+
+
+def test_complete_part_is_renamed(mirror, tmpdir):
+    leave_part(tmpdir, CONTENT, size=len(CONTENT))
+    assert download(mirror, tmpdir) == 0
+    assert RangeHandler.requests == []
+    check_complete(tmpdir)
+
+
+def test_complete_part_without_size(mirror, tmpdir):
+    # Manifests written before the size was recorded with partial entries:
+    # the server answers 416 and the file is downloaded again.
+    leave_part(tmpdir, CONTENT)
+    assert download(mirror, tmpdir) == len(CONTENT)
+    assert RangeHandler.requests == ['bytes={}-'.format(len(CONTENT)), None]
+    check_complete(tmpdir)
+    # The next run finds the complete file.
+    assert sloany.Manifest(str(tmpdir)).is_complete(
+        'spec.fits', os.path.join(str(tmpdir), 'spec.fits'))
+
+
+def test_part_larger_than_file(mirror, tmpdir):
+    leave_part(tmpdir, CONTENT + b'garbage', size=len(CONTENT))
+    assert download(mirror, tmpdir) == len(CONTENT)
+    assert RangeHandler.requests == [None]
+    check_complete(tmpdir)
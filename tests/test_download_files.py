@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Concurrent downloads with download_files against a local stand-in for a
+spectra mirror."""
+
+import http.server as server
+import os
+import time
+
+import pytest
+
+import sloany
+
+
+class FileHandler(server.BaseHTTPRequestHandler):
+    """Serve a small body for every path, except 404 for paths containing
+    'missing'. Each request is recorded as (time, client port, path)."""
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append((time.time(), self.client_address[1],
+                              self.path))
+        if 'missing' in self.path:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.path.encode('ascii') * 100
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def mirrors(http_server):
+    FileHandler.requests = []
+    return sloany.MirrorPool([http_server(FileHandler) + '/%s'],
+                             retries=1)
+
+
+def downloads(folder, names):
+    return [('26', '/4000/' + name, os.path.join(str(folder), name))
+            for name in names]
+
+
+def test_download_files(mirrors, tmpdir, capsys):
+    names = ['spec-4000-55000-{:04d}.fits'.format(i) for i in range(12)]
+    failed = sloany.download_files(downloads(tmpdir, names), jobs=3,
+                                   mirrors=mirrors)
+    assert failed == []
+    for name in names:
+        with open(str(tmpdir.join(name)), 'rb') as f:
+            assert f.read() == ('/26/4000/' + name).encode('ascii') * 100
+    assert 'Fetched 12 files' in capsys.readouterr()[0]
+
+
+def test_connections_are_reused(mirrors, tmpdir):
+    names = ['spec-4000-55000-{:04d}.fits'.format(i) for i in range(12)]
+    sloany.download_files(downloads(tmpdir, names), jobs=3, mirrors=mirrors)
+    connections = set(port for t, port, path in FileHandler.requests)
+    assert len(FileHandler.requests) == 12
+    assert len(connections) <= 3
+
+
+def test_rate_limit(mirrors, tmpdir):
+    names = ['spec-4000-55000-{:04d}.fits'.format(i) for i in range(6)]
+    sloany.download_files(downloads(tmpdir, names), jobs=3, rate=10.,
+                          mirrors=mirrors)
+    times = sorted(t for t, port, path in FileHandler.requests)
+    assert len(times) == 6
+    # Requests are started at most 10 per second, whatever the jobs.
+    for earlier, later in zip(times, times[1:]):
+        assert later - earlier > 0.08
+
+
+def test_failed_downloads(mirrors, tmpdir, capsys):
+    names = ['spec-4000-55000-0001.fits', 'missing-1.fits',
+             'spec-4000-55000-0002.fits', 'missing-2.fits']
+    tasks = downloads(tmpdir, names)
+    failed = sloany.download_files(tasks, jobs=2, mirrors=mirrors)
+    assert sorted(failed) == sorted([tasks[1], tasks[3]])
+    assert os.path.exists(tasks[0][2]) and os.path.exists(tasks[2][2])
+    assert not os.path.exists(tasks[1][2])
+    assert 'Could not retrieve missing-1.fits' in capsys.readouterr()[1]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Screening the reference spectra one at a time and in stacks."""
+
+import os
+
+import pytest
+
+import hefind
+import sloany
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+REFERENCES = [os.path.join(DATA, 'lines-{}.txt'.format(i)) for i in range(6)]
+
+
+@pytest.fixture
+def spectra(tmpdir):
+    """Return the names of the reference spectra and of copies that start
+    at other pixels or have other lengths, like the SDSS lite spectra."""
+    fnames = list(REFERENCES)
+    for i, (start, stop) in enumerate([(0, 1400), (37, 1500), (100, 1300),
+                                       (37, 1500), (0, 1500)]):
+        wavs, fluxes = hefind.load_spectrum(REFERENCES[i])
+        fname = str(tmpdir.join('cut-{}'.format(i)))
+        sloany.write_flux(fname, wavs[start:stop], fluxes[start:stop])
+        fnames.append(fname)
+    return fnames
+
+
+def check_same(result, expected):
+    assert result.fname == expected.fname
+    assert result.error == expected.error
+    assert result.types == expected.types
+    assert [line for line, sn in result.lines] == \
+        [line for line, sn in expected.lines]
+    assert [sn for line, sn in result.lines] == \
+        pytest.approx([sn for line, sn in expected.lines], rel=1e-9)
+    assert [match[::2] for match in result.matches] == \
+        [match[::2] for match in expected.matches]
+
+
+def test_helium_found():
+    candidates = [hefind.find_helium(fname).is_candidate
+                  for fname in REFERENCES]
+    assert candidates == [False, True, False, True, True, True]
+
+
+def test_positional_arguments():
+    """The threshold is still the fifth argument, after verbose."""
+    fname = REFERENCES[1]
+    result = hefind.find_helium(fname, False, False, False, 100.)
+    assert result == hefind.find_helium(fname, threshold=100.)
+    assert not result.is_candidate
+    assert hefind.find_helium(fname, False, False, True).is_candidate
+
+@pytest.mark.parametrize('stack', [2, 4, 11])
+def test_stacks_match_single_spectra(spectra, stack):
+    expected = [hefind.find_helium(fname) for fname in spectra]
+    results = list(hefind.screen_files(spectra, stack=stack))
+    assert len(results) == len(expected)
+    for result, single in zip(results, expected):
+        check_same(result, single)
+
+
+def test_stack_with_unreadable_file(spectra, tmpdir):
+    missing = str(tmpdir.join('missing'))
+    results = hefind.find_helium_batch([missing] + spectra[:3])
+    assert results[0].error is not None
+    for result, fname in zip(results[1:], spectra):
+        check_same(result, hefind.find_helium(fname))
+
+
+def test_shifted_spectra_are_stacked(tmpdir, monkeypatch):
+    """Spectra with the same number of points are screened as one array,
+    whatever their first wavelength."""
+    fnames = []
+    for i, start in enumerate([0, 13, 37, 100]):
+        wavs, fluxes = hefind.load_spectrum(REFERENCES[i])
+        fname = str(tmpdir.join('shifted-{}'.format(i)))
+        sloany.write_flux(fname, wavs[start:start + 1400],
+                          fluxes[start:start + 1400])
+        fnames.append(fname)
+    shapes = []
+    find_lines_batch = hefind.find_lines_batch
+
+    def record_shape(fluxes, *args, **kwargs):
+        shapes.append(fluxes.shape)
+        return find_lines_batch(fluxes, *args, **kwargs)
+
+    monkeypatch.setattr(hefind, 'find_lines_batch', record_shape)
+    results = hefind.find_helium_batch(fnames)
+    assert shapes == [(4, 1400)]
+    for result, fname in zip(results, fnames):
+        check_same(result, hefind.find_helium(fname))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""The lines found by find_lines in reference spectra must not change.
+
+The expected (line center, signal to noise ratio) pairs in data/lines.json
+were found by the original implementation of find_lines, which went through
+the spectrum one point at a time, for thresholds of 0.5, 1 and 2.
+
+"""
+
+import json
+import os
+
+import pytest
+
+import hefind
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+with open(os.path.join(DATA, 'lines.json')) as f:
+    EXPECTED = json.load(f)
+
+
+@pytest.mark.parametrize('fname', sorted(EXPECTED))
+def test_reference_lines(fname):
+    wavs, fluxes = hefind.load_spectrum(os.path.join(DATA, fname))
+    smoothed = hefind.smooth_spectrum(fluxes)
+    corrected = hefind.baseline(smoothed, method='tophat')
+    noise = hefind.estimate_noise(fluxes, smoothed)
+    for threshold, expected in EXPECTED[fname].items():
+        lines = hefind.find_lines(fluxes, smoothed, corrected,
+                                  threshold=float(threshold), noise=noise)
+        assert [center for center, sn in lines] == \
+            [center for center, sn in expected]
+        # The noise is now averaged with cumulative sums instead of a
+        # convolution, which changes the last digits of the ratios.
+        assert [sn for center, sn in lines] == \
+            pytest.approx([sn for center, sn in expected], rel=1e-9)
+
+
+@pytest.mark.parametrize('fname', sorted(EXPECTED))
+def test_reference_lines_batch(fname):
+    wavs, fluxes = hefind.load_spectrum(os.path.join(DATA, fname))
+    fluxes = fluxes[None, :].repeat(2, axis=0)
+    smoothed = hefind.smooth_spectrum(fluxes)
+    corrected = hefind.baseline(smoothed, method='tophat')
+    noise = hefind.estimate_noise(fluxes, smoothed)
+    expected = EXPECTED[fname]['1.0']
+    for lines in hefind.find_lines_batch(fluxes, smoothed, corrected,
+                                         threshold=1., noise=noise):
+        assert [center for center, sn in lines] == \
+            [center for center, sn in expected]
+        assert [sn for center, sn in lines] == \
+            pytest.approx([sn for center, sn in expected], rel=1e-9)
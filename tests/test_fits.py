@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Reading FITS files without pyfits, as extract_spectrum_buffer does.
+
+The file of these tests is written card by card here rather than by
+benchmarks/synthetic.py, with features the lite spectra of SDSS do not use:
+a primary HDU with data, headers longer than a block, scaled, vector, string
+and empty columns, in another order.
+
+"""
+
+import numpy
+import pytest
+
+import sloany
+
+
+def card(text):
+    return text.ljust(80).encode('ascii')
+
+
+def hdu(cards, data=b''):
+    header = b''.join(card(text) for text in cards + ['END'])
+    return (header + b' ' * (-len(header) % 2880) +
+            data + b'\0' * (-len(data) % 2880))
+
+
+NB_PTS = 50
+LOGLAM = numpy.linspace(3.5797, 3.9611, NB_PTS).astype('>f4')
+RAW_FLUX = numpy.arange(-NB_PTS, NB_PTS, 2).astype('>i2')
+FLUX = RAW_FLUX * 0.5 + 100.
+
+
+def fits_file():
+    primary = hdu(['SIMPLE  =                    T',
+                   'BITPIX  =                   16',
+                   'NAXIS   =                    2',
+                   'NAXIS1  =                   30',
+                   'NAXIS2  =                  100',
+                   'EXTEND  =                    T',
+                   "OBSERVER= 'O''Hara  '           / doubled quote"] +
+                  ['COMMENT card {}'.format(i) for i in range(40)],
+                  numpy.ones(3000, '>i2').tobytes())
+    rows = numpy.zeros(NB_PTS, [('and_mask', '>i4'), ('name', 'S3'),
+                                ('ivar', '>f4', (2,)), ('flux', '>i2'),
+                                ('loglam', '>f4')])
+    rows['and_mask'] = 16
+    rows['name'] = b'abc'
+    rows['ivar'] = 2.
+    rows['flux'] = RAW_FLUX
+    rows['loglam'] = LOGLAM
+    table = hdu(["XTENSION= 'BINTABLE'           / binary table",
+                 'BITPIX  =                    8',
+                 'NAXIS   =                    2',
+                 'NAXIS1  =                   {}'.format(
+                     rows.dtype.itemsize),
+                 'NAXIS2  =                   {}'.format(NB_PTS),
+                 'PCOUNT  =                    0',
+                 'GCOUNT  =                    1',
+                 'TFIELDS =                    6',
+                 "TTYPE1  = 'AND_MASK'",
+                 "TFORM1  = 'J       '",
+                 "TTYPE2  = 'NAME    '",
+                 "TFORM2  = '3A      '",
+                 "TTYPE3  = 'IVAR    '",
+                 "TFORM3  = '2E      '",
+                 "TTYPE4  = 'FLUX    '",
+                 "TFORM4  = 'I       '",
+                 'TSCAL4  =                  0.5',
+                 'TZERO4  =              1.0D+02',
+                 "TTYPE5  = 'EMPTY   '",
+                 "TFORM5  = '0E      '",
+                 "TTYPE6  = 'LOGLAM  '",
+                 "TFORM6  = 'E       '",
+                 "EXTNAME = 'COADD   '"],
+                rows.tobytes())
+    return primary + table
+
+
+@pytest.mark.parametrize('text, value', [
+    ("'O''Hara  '           / doubled quote", "O'Hara"),
+    ("'it''s / not a comment'", "it's / not a comment"),
+    ("''''", "'"),
+    ("''", ''),
+    ("'unterminated", 'unterminated'),
+    ('                   T', True),
+    ('                   F / comment', False),
+    ('                  42 / answer', 42),
+    ('               -1.5D+03', -1500.),
+    ('                2.5E-2', 0.025),
+])
+def test_fits_value(text, value):
+    result = sloany._fits_value(text)
+    assert result == value
+    assert type(result) is type(value)
+
+
+def test_read_fits_columns():
+    data = fits_file()
+    columns = sloany.read_fits_columns(data, ['LogLam', 'flux', 'ivar',
+                                              'name', 'and_mask'])
+    numpy.testing.assert_array_equal(columns['LogLam'], LOGLAM)
+    numpy.testing.assert_allclose(columns['flux'], FLUX)
+    assert columns['ivar'].shape == (NB_PTS, 2)
+    assert (columns['name'] == b'abc').all()
+    assert (columns['and_mask'] == 16).all()
+    with pytest.raises(ValueError):
+        sloany.read_fits_columns(data, ['flux'], hdu=0)
+    with pytest.raises(ValueError):
+        sloany.read_fits_columns(data[:-2880], ['flux'])
+
+
+def test_extract_spectrum_buffer():
+    wavs, fluxes = sloany.extract_spectrum_buffer(fits_file())
+    numpy.testing.assert_allclose(wavs, 10**LOGLAM, rtol=1e-6)
+    numpy.testing.assert_allclose(fluxes, FLUX)
+
+
+def test_same_as_pyfits(tmpdir):
+    pytest.importorskip('pyfits')
+    fname = str(tmpdir.join('spec.fits'))
+    data = fits_file()
+    with open(fname, 'wb') as f:
+        f.write(data)
+    wavs, fluxes = sloany.extract_spectrum(fname)
+    buffer_wavs, buffer_fluxes = sloany.extract_spectrum_buffer(data)
+    numpy.testing.assert_allclose(buffer_wavs, wavs, rtol=1e-6)
+    numpy.testing.assert_allclose(buffer_fluxes, fluxes, rtol=1e-6)
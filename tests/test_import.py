@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""Screening spectra must not import plotting or scipy."""
+
+import pytest
+
+import bench_import
+
+
+@pytest.mark.parametrize('module', ['hefind', 'specstore'])
+def test_no_heavy_imports(module):
+    times = bench_import.import_times(module)
+    assert module in times
+    imported = set(name.split('.')[0] for name in times)
+    assert not imported & set(bench_import.FORBIDDEN)
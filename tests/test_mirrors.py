@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Ranking of the spectra mirrors by MirrorPool.probe."""
+
+import http.server as server
+import socket
+import time
+
+import pytest
+
+import sloany
+
+
+class StatusHandler(server.BaseHTTPRequestHandler):
+    """Answer HEAD requests with a 503 under /down and 200 elsewhere."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(503 if self.path.startswith('/down') else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+@pytest.fixture
+def base_url(http_server):
+    return http_server(StatusHandler)
+
+
+@pytest.fixture
+def black_hole():
+    """URL of a server that accepts connections but never answers."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    yield 'http://127.0.0.1:{}/%s'.format(sock.getsockname()[1])
+    sock.close()
+
+
+def test_probe_ranks_failing_mirrors_last(base_url, black_hole):
+    up = base_url + '/up/%s'
+    down = base_url + '/down/%s'
+    mirrors = sloany.MirrorPool([black_hole, down, up])
+    start = time.time()
+    mirrors.probe(sloany.ConnectionPool(), '26', timeout=0.5)
+    # The mirrors are probed at the same time and not retried.
+    assert time.time() - start < 1.5
+    assert mirrors.ranked()[0] == up
+    assert mirrors.failures == {black_hole: 1, down: 1, up: 0}
+
+
+@pytest.mark.parametrize('mirrors, retries', [([], 3), (['url/%s'], 0)])
+def test_invalid_mirror_pool(mirrors, retries):
+    with pytest.raises(ValueError):
+        sloany.MirrorPool(mirrors, retries=retries)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Several queries executed at once, their results merged and their
+metadata files."""
+
+import csv
+import http.server as server
+import io
+import os
+import re
+import urllib.parse as parse
+
+import pytest
+
+import sloany
+
+
+COLUMNS = ['plate', 'mjd', 'fiberid', 'ra', 'dec']
+OBJECTS = [('4000', '55000', str(fiber), str(10. + fiber), str(-5. + fiber))
+           for fiber in range(1, 8)]
+
+
+class FibersHandler(server.BaseHTTPRequestHandler):
+    """Answer queries ending with ``where fiberid between A and B`` with the
+    objects whose fiber is in that range."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = parse.parse_qs(parse.urlsplit(self.path).query)['cmd'][0]
+        first, last = re.search(r'between (\d+) and (\d+)', query).groups()
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(COLUMNS)
+        writer.writerows(obj for obj in OBJECTS
+                         if int(first) <= int(obj[2]) <= int(last))
+        body = out.getvalue().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def query(first, last):
+    return ('select plate, mjd, fiberid, ra, dec from specobj '
+            'where fiberid between {} and {}'.format(first, last))
+
+
+@pytest.fixture
+def skyserver(monkeypatch, http_server):
+    monkeypatch.setattr(sloany, 'skyserver_url',
+                        http_server(FibersHandler) + '/')
+    monkeypatch.setattr(sloany, 'read_config', lambda: {})
+
+
+@pytest.fixture
+def workdir(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    return tmpdir
+
+
+def write_queries(workdir, ranges):
+    fnames = []
+    for label, (first, last) in ranges:
+        fname = str(workdir.join(label + '.sql'))
+        with open(fname, 'w') as f:
+            f.write(query(first, last))
+        fnames.append(fname)
+    return fnames
+
+
+def read_metadata(fname):
+    with open(fname) as f:
+        return [line.split()[0] for line in f]
+
+
+def specfiles(first, last):
+    return [sloany.specfile_name({'plate': 4000, 'mjd': 55000,
+                                  'fiberid': fiber})
+            for fiber in range(first, last + 1)]
+
+
+def test_merge_results():
+    rows = [{'plate': '1', 'mjd': '2', 'fiberid': str(fiber)}
+            for fiber in range(4)]
+    no_key = {'name': 'no spectrum'}
+    merged = sloany.merge_results([[rows[2], rows[0], no_key],
+                                   [dict(rows[0]), rows[1], no_key],
+                                   [], [rows[3], rows[2]]])
+    assert merged == [rows[2], rows[0], no_key, rows[1], no_key, rows[3]]
+    assert merged[1] is rows[0]
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_exec_queries(skyserver, jobs):
+    queries = [query(5, 7), query(1, 2), query(8, 9), query(2, 3)]
+    results = list(sloany.exec_queries(queries, jobs=jobs))
+    assert [[sloany.spec_key(row)[2] for row in rows]
+            for rows in results] == [[5, 6, 7], [1, 2], [], [2, 3]]
+    assert dict(results[1][0].items()) == dict(zip(COLUMNS, OBJECTS[0]))
+    assert list(sloany.exec_queries([])) == []
+
+
+def test_metadata_files(skyserver, workdir, capsys):
+    sloany.run(['--no-cache'] + write_queries(
+        workdir, [('first', (1, 3)), ('second', (2, 5))]))
+    assert read_metadata('METADATA') == specfiles(1, 5)
+    assert read_metadata('METADATA.first') == specfiles(1, 3)
+    assert read_metadata('METADATA.second') == specfiles(2, 5)
+    assert '2 queries returned 5 distinct spectra' in capsys.readouterr().out
+
+
+def test_empty_query_is_skipped(skyserver, workdir, capsys):
+    sloany.run(['--no-cache', '--query', query(6, 7)] + write_queries(
+        workdir, [('empty', (8, 9)), ('other', (1, 2))]))
+    assert 'query empty did not provide any results' in \
+        capsys.readouterr().err
+    assert read_metadata('METADATA') == specfiles(6, 7) + specfiles(1, 2)
+    assert read_metadata('METADATA.query') == specfiles(6, 7)
+    assert read_metadata('METADATA.other') == specfiles(1, 2)
+    assert not os.path.exists('METADATA.empty')
+
+
+def test_all_queries_empty(skyserver, workdir):
+    with pytest.raises(SystemExit) as error:
+        sloany.run(['--no-cache'] + write_queries(
+            workdir, [('empty', (8, 9)), ('none', (0, 0))]))
+    assert error.value.code == 1
+    assert not os.path.exists('METADATA')
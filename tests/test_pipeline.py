@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""The fetch, reduce and screen pipeline against a local fake spectra
+mirror serving synthetic spectra."""
+
+import threading
+
+import pytest
+
+import sloany
+import synthetic
+
+
+NB_SPECTRA = 6
+
+
+@pytest.fixture(scope='module')
+def mirror(tmpdir_factory):
+    root = str(tmpdir_factory.mktemp('sas'))
+    objects, helium = synthetic.write_fits_files(root, NB_SPECTRA,
+                                                 helium_fraction=0.5)
+    with synthetic.FakeSDSSServer(root, objects) as server:
+        yield server.mirror, objects, helium
+
+
+def pipeline_objects(objects):
+    return [(sloany.specfile_name(obj), obj['plate'], obj['run2d'],
+             'J{:04d}'.format(obj['fiberid'])) for obj in objects]
+
+
+def run_pipeline(*args, **kwargs):
+    """Run sloany.run_pipeline in a thread and return its results, failing
+    instead of hanging if it does not finish."""
+    outcome = []
+    errors = []
+
+    def target():
+        try:
+            outcome.append(sloany.run_pipeline(*args, **kwargs))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), 'run_pipeline hangs'
+    if errors:
+        raise errors[0]
+    return outcome[0]
+
+
+@pytest.mark.parametrize('screen_jobs', [1, 2])
+def test_pipeline(mirror, screen_jobs):
+    url, objects, helium = mirror
+    results = run_pipeline(pipeline_objects(objects), dest=None, jobs=2,
+                           screen_jobs=screen_jobs, mirrors=[url])
+    candidates = dict((result.fname, result.is_candidate)
+                      for result in results)
+    assert candidates == dict(('J{:04d}'.format(obj['fiberid']), bool(he))
+                              for obj, he in zip(objects, helium))
+
+
+@pytest.mark.parametrize('screen_jobs', [1, 2])
+def test_bad_object_is_a_failed_download(mirror, capsys, screen_jobs):
+    url, objects, helium = mirror
+    tasks = pipeline_objects(objects)
+    tasks.insert(1, ('spec-abcd-55000-0001.fits', 'abc', '26', 'Jbad'))
+    results = run_pipeline(tasks, dest=None, jobs=1,
+                           screen_jobs=screen_jobs, mirrors=[url])
+    assert len(results) == NB_SPECTRA
+    assert 'Could not retrieve spec-abcd-55000-0001.fits' in \
+        capsys.readouterr().err
+
+
+class FailingStore(object):
+    """A spectrum store that cannot be written to."""
+    def add(self, *args):
+        raise IOError('disk full')
+
+
+@pytest.mark.parametrize('screen_jobs', [1, 2])
+def test_store_error_stops_pipeline(mirror, screen_jobs):
+    """An error while handling the results stops the pipeline, even when
+    more spectra are waiting for the workers than the queue holds."""
+    url, objects, helium = mirror
+    with pytest.raises(IOError, match='disk full'):
+        run_pipeline(pipeline_objects(objects), dest=None, jobs=2,
+                     screen_jobs=screen_jobs, mirrors=[url],
+                     store=FailingStore(), queue_size=2)
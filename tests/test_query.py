@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Queries to a local fake skyserver."""
+
+import csv
+import http.server as server
+import io
+
+import pytest
+
+import sloany
+
+
+COLUMNS = ['plate', 'mjd', 'fiberid', 'comment']
+ROWS = [('4000', '55000', str(fiber), 'fiber, "{}"'.format(fiber))
+        for fiber in range(5)]
+
+
+class QueryHandler(server.BaseHTTPRequestHandler):
+    """Answer every query with the CSV of ROWS."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(COLUMNS)
+        writer.writerows(ROWS)
+        body = out.getvalue().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def skyserver(monkeypatch, http_server):
+    monkeypatch.setattr(sloany, 'skyserver_url',
+                        http_server(QueryHandler) + '/')
+
+
+def test_rows_are_dicts(skyserver):
+    rows = sloany.exec_query('select * from spectra')
+    assert rows == [dict(zip(COLUMNS, row)) for row in ROWS]
+    # Quoted fields with commas and quotes are parsed.
+    assert rows[1]['comment'] == 'fiber, "1"'
+
+
+def test_compact_rows(skyserver):
+    rows = sloany.exec_query('select * from spectra', compact=True)
+    assert [tuple(row) for row in rows] == ROWS
+    assert rows[2]['fiberid'] == '2'
+    assert rows[2].get('ra') is None
+    assert 'plate' in rows[2]
+    assert rows[2].keys() == COLUMNS
+    assert rows[2].items() == list(zip(COLUMNS, ROWS[2]))
+
+
+def test_cached_rows(skyserver, tmpdir):
+    cache = sloany.QueryCache(str(tmpdir))
+    query = 'select * from spectra'
+    assert list(sloany.iter_query(query, cache=cache)) == \
+        sloany.exec_query(query)
+    assert cache.get(query) is not None
+    for compact in (False, True):
+        assert list(sloany.iter_query(query, cache=cache,
+                                      compact=compact)) == \
+            sloany.exec_query(query, compact=compact)
+
+
+def test_large_results_are_not_cached(skyserver, tmpdir):
+    query = 'select * from spectra'
+    cache = sloany.QueryCache(str(tmpdir), max_rows=len(ROWS) - 1)
+    assert len(list(sloany.iter_query(query, cache=cache))) == len(ROWS)
+    assert cache.get(query) is None
+    cache.max_rows = len(ROWS)
+    list(sloany.iter_query(query, cache=cache))
+    assert cache.get(query) is not None
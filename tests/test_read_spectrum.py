@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""read_spectrum must read every file the same way as read_list does."""
+
+import io
+
+import numpy
+import pytest
+
+import hefind
+import sloany
+
+
+def read_with_list(text):
+    """Read a spectrum with read_list only, as hefind used to."""
+    f = io.StringIO(text)
+    nb_wavs = int(f.readline().split()[0])
+    return hefind.read_list(f, nb_wavs), hefind.read_list(f, nb_wavs)
+
+
+def check_same(text):
+    wavs, fluxes = hefind.read_spectrum(io.StringIO(text))
+    expected_wavs, expected_fluxes = read_with_list(text)
+    numpy.testing.assert_array_equal(wavs, expected_wavs)
+    numpy.testing.assert_array_equal(fluxes, expected_fluxes)
+    return wavs, fluxes
+
+
+def sloany_text(wavs, fluxes, tmpdir):
+    fname = str(tmpdir.join('spectrum'))
+    sloany.write_flux(fname, wavs, fluxes)
+    with open(fname) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('nb_wavs', [60, 61, 65, 7])
+def test_sloany_layout(tmpdir, nb_wavs):
+    """Values separated by whitespace, with a last flux line that is full or
+    not."""
+    wavs = numpy.linspace(3800., 9200., nb_wavs)
+    fluxes = numpy.random.RandomState(0).uniform(0.5, 20., nb_wavs)
+    text = sloany_text(wavs, fluxes, tmpdir)
+    result_wavs, result_fluxes = check_same(text)
+    assert len(result_fluxes) == nb_wavs
+
+
+@pytest.mark.parametrize('nb_wavs', [60, 61, 65, 7])
+def test_run_together_negative_fluxes(tmpdir, nb_wavs):
+    """Negative fluxes fill all 12 characters of their field and run into
+    the previous value."""
+    wavs = numpy.linspace(3800., 9200., nb_wavs)
+    fluxes = numpy.random.RandomState(1).uniform(-20., 20., nb_wavs)
+    text = sloany_text(wavs, fluxes, tmpdir)
+    assert '-' in text and any(
+        token.count('.') > 1 for token in text.split())
+    result_wavs, result_fluxes = check_same(text)
+    numpy.testing.assert_allclose(result_fluxes, fluxes, rtol=1e-5)
+
+
+def test_non_numeric_tokens():
+    """Values that are not numbers are read as 0."""
+    text = ('4\n'
+            '   3800.00   3801.00   3802.00   3803.00\n'
+            ' 1.00000e+00         nan       *****  4.00000e+00\n')
+    wavs, fluxes = check_same(text)
+    assert fluxes[2] == 0
+
+
+def test_non_numeric_run_together():
+    text = ('3\n'
+            '   3800.00   3801.00   3802.00\n'
+            '-1.00000e+00-**********-3.00000e+00\n')
+    wavs, fluxes = check_same(text)
+    assert fluxes[1] == 0
+
+
+def test_fields_of_8_characters():
+    """Values written in fields of 8 characters run together when they
+    have more than 4 digits before the point."""
+    text = ('5\n'
+            '10000.0010001.5010003.00\n'
+            '10004.2510005.75\n'
+            '   1.250   2.500   3.750\n'
+            '   5.00012345.67\n')
+    wavs, fluxes = check_same(text)
+    assert list(wavs) == [10000., 10001.5, 10003., 10004.25, 10005.75]
+    assert list(fluxes) == [1.25, 2.5, 3.75, 5., 12345.67]
+
+
+def test_last_flux_line_not_full(tmpdir):
+    """The last flux line of a spectrum may hold fewer than 6 values or
+    lose its trailing spaces."""
+    wavs = numpy.linspace(3800., 9200., 9)
+    fluxes = numpy.array([1., -2., 3., -4., 5., -6., 7., -8., -9.])
+    text = sloany_text(wavs, fluxes, tmpdir)
+    check_same(text)
+    check_same(text.rstrip('\n'))
+    check_same(text.rstrip('\n') + '   \n')
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""Reduction of spectra with reduce_spectra."""
+
+import os
+
+import pytest
+
+import sloany
+
+
+@pytest.fixture(autouse=True)
+def answer_yes(monkeypatch):
+    monkeypatch.setattr('builtins.input', lambda prompt: 'y')
+
+
+@pytest.mark.parametrize('jobs', [0, 1, 2])
+def test_reduce_missing_file(tmpdir, capsys, jobs):
+    sloany.reduce_spectra(['spec-4000-55000-0001.fits'], ['J000000.00'],
+                          dest=str(tmpdir), src=str(tmpdir), jobs=jobs)
+    out, err = capsys.readouterr()
+    assert 'Could not reduce' in err
+    assert '1 failed' in out
+
+
+def test_reduce_nothing(tmpdir, capsys):
+    sloany.reduce_spectra([], [], dest=str(tmpdir), jobs=0)
+    assert 'Reduced 0 spectra' in capsys.readouterr()[0]
+
+
+def test_reduce_creates_dest(tmpdir):
+    dest = str(tmpdir.join('reduced', 'spectra'))
+    sloany.reduce_spectra(['spec-4000-55000-0001.fits'], ['J000000.00'],
+                          dest=dest, src=str(tmpdir))
+    assert os.path.isdir(dest)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Incremental screening: which files are screened again and which results
+are taken from the ResultCache."""
+
+import os
+import shutil
+
+import pytest
+
+import hefind
+import sloany
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+REFERENCES = [os.path.join(DATA, 'lines-{}.txt'.format(i)) for i in range(3)]
+
+
+@pytest.fixture
+def spectra(tmpdir):
+    """Return the names of copies of the reference spectra."""
+    fnames = []
+    for i, reference in enumerate(REFERENCES):
+        fname = str(tmpdir.join('spec-{}'.format(i)))
+        shutil.copy(reference, fname)
+        fnames.append(fname)
+    return fnames
+
+
+@pytest.fixture
+def screened(monkeypatch):
+    """Return the list of the files screened by find_helium, which grows as
+    they are screened."""
+    fnames = []
+    find_helium = hefind.find_helium
+
+    def record(fname, **options):
+        fnames.append(fname)
+        return find_helium(fname, **options)
+
+    monkeypatch.setattr(hefind, 'find_helium', record)
+    return fnames
+
+
+def screen(fnames, tmpdir, **options):
+    with hefind.ResultCache(str(tmpdir.join('cache', 'results.db'))) as cache:
+        results = list(hefind.screen_incremental(fnames, cache, **options))
+        return results, (cache.hits, cache.misses)
+
+
+def check_same(results, fnames):
+    assert [result.fname for result in results] == fnames
+    for result, fname in zip(results, fnames):
+        expected = hefind.find_helium(fname)
+        assert result.types == expected.types
+        assert result.lines == pytest.approx(expected.lines)
+        assert result.noise == pytest.approx(expected.noise)
+
+
+def test_unchanged(spectra, screened, tmpdir):
+    results, counts = screen(spectra, tmpdir)
+    assert counts == (0, 3)
+    assert screened == spectra
+    del screened[:]
+    results, counts = screen(spectra, tmpdir)
+    assert counts == (3, 0)
+    assert screened == []
+    check_same(results, spectra)
+
+
+def test_touched_file(spectra, screened, tmpdir):
+    """A file with a new modification time but the same content is found
+    through its hash."""
+    screen(spectra, tmpdir)
+    stat = os.stat(spectra[1])
+    os.utime(spectra[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    del screened[:]
+    results, counts = screen(spectra, tmpdir)
+    assert counts == (3, 0)
+    assert screened == []
+    check_same(results, spectra)
+
+
+def test_changed_content(spectra, screened, tmpdir):
+    screen(spectra, tmpdir)
+    wavs, fluxes = hefind.load_spectrum(spectra[1])
+    sloany.write_flux(spectra[1], wavs, 2 * fluxes)
+    del screened[:]
+    results, counts = screen(spectra, tmpdir)
+    assert counts == (2, 1)
+    assert screened == [spectra[1]]
+    check_same(results, spectra)
+
+
+@pytest.mark.parametrize('options', [
+    {'threshold': 2.},
+    {'catalog': hefind.load_catalog('wd')},
+    {'catalog': hefind.load_catalog('helium', tolerance=3.)},
+    {'baseline_method': 'tophat'},
+])
+def test_changed_params(spectra, screened, tmpdir, options):
+    screen(spectra, tmpdir)
+    del screened[:]
+    results, counts = screen(spectra, tmpdir, **options)
+    assert counts == (0, 3)
+    assert screened == spectra
+    del screened[:]
+    results, counts = screen(spectra, tmpdir, **options)
+    assert counts == (3, 0)
+    results, counts = screen(spectra, tmpdir)
+    assert counts == (3, 0)
+
+
+def test_copied_and_renamed(spectra, screened, tmpdir):
+    """Files with the content of a screened file get its result."""
+    screen(spectra, tmpdir)
+    copy = str(tmpdir.join('copy'))
+    shutil.copy(spectra[0], copy)
+    renamed = str(tmpdir.join('renamed'))
+    os.rename(spectra[2], renamed)
+    fnames = [spectra[0], spectra[1], renamed, copy]
+    del screened[:]
+    results, counts = screen(fnames, tmpdir)
+    assert counts == (4, 0)
+    assert screened == []
+    check_same(results, fnames)
+
+
+def test_errors_not_stored(spectra, screened, tmpdir):
+    bad = str(tmpdir.join('bad'))
+    with open(bad, 'w') as f:
+        f.write('not a spectrum\n')
+    missing = str(tmpdir.join('missing'))
+    fnames = spectra + [bad, missing]
+    results, counts = screen(fnames, tmpdir)
+    assert counts == (0, 5)
+    assert [result.error is not None for result in results] == \
+        [False, False, False, True, True]
+    del screened[:]
+    results, counts = screen(fnames, tmpdir)
+    assert counts == (3, 2)
+    assert screened == [bad, missing]
+    assert results[3].error is not None
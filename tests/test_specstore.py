@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Spectrum stores, and reading them with hefind and sloany --export."""
+
+import os
+
+import numpy
+import pytest
+
+import hefind
+import sloany
+import specstore
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+REFERENCES = [os.path.join(DATA, 'lines-{}.txt'.format(i)) for i in range(3)]
+
+
+@pytest.fixture
+def store_path(tmpdir):
+    """Return the path of a store holding the reference spectra, named
+    spec-0 to spec-2."""
+    path = str(tmpdir.join('store'))
+    with specstore.SpectrumStore(path, 'a') as store:
+        for i, fname in enumerate(REFERENCES):
+            wavs, fluxes = hefind.load_spectrum(fname)
+            store.add('spec-{}'.format(i), wavs, fluxes, plate=266,
+                      mjd=51630, fiber=i + 1)
+    return path
+
+
+def test_round_trip(store_path):
+    with specstore.SpectrumStore(store_path) as store:
+        assert len(store) == 3
+        assert list(store) == ['spec-0', 'spec-1', 'spec-2']
+        assert store.find(266, 51630, 2) == 'spec-1'
+        assert store.find(266, 51630, 4) is None
+        for i, fname in enumerate(REFERENCES):
+            expected_wavs, expected_fluxes = hefind.load_spectrum(fname)
+            wavs, fluxes = store.get('spec-{}'.format(i))
+            assert wavs.dtype == numpy.float32
+            assert fluxes.dtype == numpy.float32
+            numpy.testing.assert_array_equal(
+                wavs, expected_wavs.astype(numpy.float32))
+            numpy.testing.assert_array_equal(
+                fluxes, expected_fluxes.astype(numpy.float32))
+
+
+def test_supersede(store_path):
+    with specstore.SpectrumStore(store_path, 'a') as store:
+        store.add('spec-1', [1., 2.], [3., 4.], plate=266, mjd=51630,
+                  fiber=2)
+        assert len(store) == 3
+    with specstore.SpectrumStore(store_path) as store:
+        assert len(store) == 3
+        wavs, fluxes = store.get('spec-1')
+        assert list(wavs) == [1., 2.]
+        assert list(fluxes) == [3., 4.]
+        assert len(store.get('spec-2')[0]) == \
+            len(hefind.load_spectrum(REFERENCES[2])[0])
+
+
+def test_truncated_index(store_path):
+    """An index entry cut short by an interruption is skipped."""
+    fname = os.path.join(store_path, specstore.INDEX_FILE)
+    with open(fname) as f:
+        text = f.read()
+    with open(fname, 'w') as f:
+        f.write(text[:-10])
+    with specstore.SpectrumStore(store_path) as store:
+        assert list(store) == ['spec-0', 'spec-1']
+        numpy.testing.assert_array_equal(
+            store.get('spec-1')[1],
+            hefind.load_spectrum(REFERENCES[1])[1].astype(numpy.float32))
+
+
+def test_read_only(store_path, tmpdir):
+    with specstore.SpectrumStore(store_path) as store:
+        with pytest.raises(IOError):
+            store.add('spec-3', [1.], [2.])
+    with pytest.raises(IOError):
+        specstore.SpectrumStore(str(tmpdir.join('missing')))
+    with pytest.raises(ValueError):
+        specstore.SpectrumStore(store_path, 'w')
+
+
+def test_hefind_reads_store(store_path):
+    fnames = list(hefind.iter_filenames([store_path]))
+    assert fnames == [os.path.join(store_path, 'spec-{}'.format(i))
+                      for i in range(3)]
+    for fname, reference in zip(fnames, REFERENCES):
+        wavs, fluxes = hefind.load_spectrum(fname)
+        numpy.testing.assert_array_equal(
+            fluxes, hefind.load_spectrum(reference)[1].astype(numpy.float32))
+        assert hefind.find_helium(fname).is_candidate == \
+            hefind.find_helium(reference).is_candidate
+    with pytest.raises(IOError):
+        hefind.load_spectrum(os.path.join(store_path, 'spec-3'))
+
+
+def test_export(store_path, tmpdir):
+    dest = str(tmpdir.join('spectra'))
+    sloany.run(['--export', store_path, '--reduce', dest])
+    assert sorted(os.listdir(dest)) == ['spec-0', 'spec-1', 'spec-2']
+    with specstore.SpectrumStore(store_path) as store:
+        for name in store:
+            wavs, fluxes = hefind.load_spectrum(os.path.join(dest, name))
+            expected_wavs, expected_fluxes = store.get(name)
+            numpy.testing.assert_allclose(wavs, expected_wavs, atol=0.005)
+            numpy.testing.assert_allclose(fluxes, expected_fluxes, rtol=1e-5)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""The reduced spectra written by write_flux must stay byte for byte what
+fitchi2 reads."""
+
+import os
+
+import numpy
+import pytest
+
+import sloany
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def read_reference():
+    """Return the wavelengths and fluxes of the reference spectrum, as
+    float32 like the spectra read from the FITS files."""
+    values = numpy.loadtxt(os.path.join(DATA, 'spectrum.txt'),
+                           dtype=numpy.float32)
+    return values[:, 0], values[:, 1]
+
+
+def fitchi2_format(wavs, flux):
+    """Format the spectrum one value at a time, the way write_flux used to
+    do it."""
+    text = str(len(wavs))
+    for i, wav in enumerate(wavs):
+        if i % 10 == 0:
+            text += '\n'
+        text += '%10.2f' % wav
+    for i, fluxi in enumerate(flux):
+        if i % 6 == 0:
+            text += '\n'
+        text += '%12.5e' % fluxi
+    return text + '\n'
+
+
+def test_golden_file(tmpdir):
+    fname = str(tmpdir.join('J000000.00'))
+    sloany.write_flux(fname, *read_reference())
+    with open(os.path.join(DATA, 'spectrum.fitchi2'), 'rb') as f:
+        expected = f.read()
+    with open(fname, 'rb') as f:
+        assert f.read() == expected
+
+
+@pytest.mark.parametrize('length', list(range(0, 25)) + [59, 60, 61])
+def test_all_lengths(tmpdir, length):
+    wavs, flux = read_reference()
+    wavs = numpy.resize(wavs, length)
+    flux = numpy.resize(flux, length)
+    fname = str(tmpdir.join('J000000.00'))
+    sloany.write_flux(fname, wavs, flux)
+    with open(fname) as f:
+        assert f.read() == fitchi2_format(wavs, flux)